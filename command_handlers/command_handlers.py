@@ -1,5 +1,4 @@
 import asyncio
-import os
 
 from darkPy import helpers
 from darkPy.channel import ChannelType
@@ -7,13 +6,6 @@ from darkPy.channel import ChannelType
 log = helpers.setup_logger()
 
 
-def close_connection(voice, loop):
-    def closer():
-        asyncio.run_coroutine_threadsafe(voice.disconnect(), loop)
-
-    return closer
-
-
 @asyncio.coroutine
 def handle_play(args, message, client):
     """
@@ -27,10 +19,15 @@ def handle_play(args, message, client):
     """
     log.info("Handling command")
     if len(args) > 1:
-        path = "audio/" + args[1] + ".wav"
-        channel = client.get_channel(message.channel_id)
-        guild = client.get_guild_for_channel(channel)
-        log.info(guild.channels[message.channel_id])
+        name = args[1]
+        sound = client.sounds.find(name) if client.sounds is not None else None
+        if sound is None and not name.startswith(("http://", "https://")) and client.sounds is not None:
+            suggestions = client.sounds.suggest(name, cutoff=0.5)
+            if suggestions:
+                # a typo of a clip, looking it up on youtube would take seconds for nothing
+                log.info("No sound %s, did you mean %s", name, ", ".join(s.name for _, s in suggestions))
+                return
+        guild = client.get_guild_for_channel(message.channel_id)
         user_channel = guild.get_voice_channel_for_user(message.author.id)
         if user_channel is None:
             channels = []
@@ -43,20 +40,22 @@ def handle_play(args, message, client):
                 user_channel = channels[0]
         log.info("Starring voice connection")
         log.info(user_channel.guild)
-        voice = client.voice_client_in(guild)
+        # a connection lingering from an earlier clip is reused, only the channel may need to change
+        voice = client.voice_pool.acquire(guild)
         if voice is None:
             voice = yield from client.join_voice_channel(user_channel)
-            if voice.channel.id != user_channel.id:
-                yield from voice.move_to(channels[0])
+        elif voice.channel.id != user_channel.id:
+            yield from voice.move_to(user_channel)
         log.info("playing some audio")
         if voice.player is not None:
             voice.player.after = None
             voice.player.stop()
-        if os.path.exists(path):
-            player = voice.create_ffmpeg_player(path, after=close_connection(voice, client.loop))
+        if sound is not None:
+            player = voice.create_ffmpeg_player(sound.path, after=client.voice_pool.releaser(voice),
+                                                **sound.player_options())
             player.start()
         else:
-            player = yield from voice.create_ytdl_player(args[1], after=close_connection(voice,client.loop))
+            player = yield from voice.create_ytdl_player(name, after=client.voice_pool.releaser(voice))
             player.start()
     else:
         log.info("Please specify a file to play")
@@ -64,9 +63,8 @@ def handle_play(args, message, client):
 
 @asyncio.coroutine
 def handle_stop(args, message, client):
-    channel = client.get_channel(message.channel_id)
-    guild = client.get_guild_for_channel(channel)
-    voice = client.voice_client_in(guild)
+    guild = client.get_guild_for_channel(message.channel_id)
+    voice = client.voice_pool.acquire(guild)
     log.info(voice)
     if voice is not None:
         yield from voice.disconnect()
@@ -0,0 +1,334 @@
+import asyncio
+import os
+import struct
+import tempfile
+import time
+from collections import OrderedDict
+
+from darkPy import helpers, metrics
+from darkPy.cache import LRUCache
+
+log = helpers.setup_logger()
+
+cache_requests = metrics.registry.counter('darkpy_audio_cache_requests_total', 'Remote audio requests by cache result',
+                                          ('result',))
+bytes_saved = metrics.registry.counter('darkpy_audio_cache_bytes_saved_total',
+                                       'Bytes not downloaded again because the audio was cached')
+cache_bytes = metrics.registry.gauge('darkpy_audio_cache_bytes', 'Bytes of audio in the disk cache')
+cache_hit_ratio = metrics.registry.gauge('darkpy_audio_cache_hit_ratio',
+                                         'Fraction of remote audio requests played from the disk cache')
+
+# the magic, a version and the amount of bytes streaming the track downloads, then the packets
+_header = struct.Struct('<4sBQ')
+_magic = b'DPOP'
+_version = 1
+_packet = struct.Struct('<H')
+
+# temporary files older than this many seconds are left behind by a crash, no track plays that long
+leftover_age = 3600.0
+
+# what is kept of the track info, to describe a player without extracting the track again
+_track_info = ('title', 'desciption', 'duration', 'uploader', 'view_count', 'like_count', 'dislike_count',
+               'upload_date')
+
+
+class PacketReader:
+    """Reads the Opus packets of a cache entry one by one"""
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        magic, version, self.source_bytes = _header.unpack(self._file.read(_header.size))
+        if magic != _magic or version != _version:
+            self._file.close()
+            raise ValueError('{} is not a cached audio file'.format(path))
+
+    def read_packet(self):
+        """
+        :return: The next packet, None at the end
+        :rtype: bytes
+        """
+        length = self._file.read(_packet.size)
+        if len(length) != _packet.size:
+            return None
+        size, = _packet.unpack(length)
+        packet = self._file.read(size)
+        return packet if len(packet) == size else None
+
+    def close(self):
+        self._file.close()
+
+
+def _source_bytes(info):
+    """What streaming a track downloads, as far as youtube-dl knows it"""
+    size = info.get('filesize') or info.get('filesize_approx')
+    if size:
+        return int(size)
+    # kbit/s
+    bitrate = info.get('abr') or info.get('tbr')
+    if bitrate and info.get('duration'):
+        return int(bitrate * 125 * info['duration'])
+    return 0
+
+
+def _remove(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class CacheWriter:
+    """
+    Writes the packets a player sends into a cache entry, used from the player thread. The entry is only kept
+    when the whole track was played, see :meth:`finish`.
+    """
+
+    def __init__(self, cache, key, duration, source_bytes):
+        self.cache = cache
+        self.key = key
+        self.duration = duration
+        self.source_bytes = source_bytes
+        self.packets = 0
+        self._file = None
+        self._path = None
+        self._failed = False
+
+    def write(self, packet):
+        if self._failed:
+            return
+        try:
+            if self._file is None:
+                fd, self._path = tempfile.mkstemp(dir=self.cache.directory, suffix='.tmp')
+                self._file = os.fdopen(fd, 'wb')
+                self._file.write(_header.pack(_magic, _version, self.source_bytes))
+            self._file.write(_packet.pack(len(packet)))
+            self._file.write(packet)
+        except OSError as e:
+            # playing goes on, only the recording is lost
+            log.warning('Could not record %s: %r', self.key, e)
+            self._failed = True
+            return
+        self.packets += 1
+
+    def finish(self, frame_length):
+        """
+        Keep the entry, when it holds the whole track
+
+        :param frame_length: Seconds of audio per packet
+        :type frame_length: float
+        """
+        played = self.packets * frame_length
+        if self._failed or self._file is None or (self.duration and abs(played - self.duration) > 2.0):
+            log.debug('Not caching %s, recorded %.1fs of %ss', self.key, played, self.duration)
+            self.abort()
+            return
+        try:
+            self._file.close()
+            size = os.path.getsize(self._path)
+            if size > self.cache.max_bytes // 4:
+                raise ValueError('larger than a quarter of the cache')
+            # replaces an entry another process recorded meanwhile, it holds the same track
+            os.replace(self._path, self.cache.path_for(self.key))
+        except (OSError, ValueError) as e:
+            log.warning('Could not cache %s: %r', self.key, e)
+            self.abort()
+            return
+        self._done(size)
+
+    def abort(self):
+        if self._file is not None:
+            self._file.close()
+            _remove((self._path,))
+            self._file = None
+
+    def _done(self, size):
+        try:
+            self.cache.loop.call_soon_threadsafe(self.cache._written, self.key, size)
+        except RuntimeError:
+            # the loop is closed already
+            pass
+
+
+class AudioCache:
+    """
+    Keeps remote audio on disk as Opus packets, so playing it again needs neither a download nor encoding.
+
+    The packets are recorded while a track is played for the first time, see :meth:`writer`. Entries are keyed
+    on the extractor and the id of the track, and the urls and queries that resolved to it are remembered so a
+    repeated request does not even need to be extracted again. The least recently played
+    entries are removed when the cache grows beyond ``max_bytes``. Entries are written to a temporary file and
+    renamed into place, so readers and other writers never see half an entry.
+    """
+
+    def __init__(self, directory, *, loop, max_bytes=1 << 30, max_duration=1200, aliases=10000):
+        """
+        :param directory: Where the entries are stored, created on start when it does not exist
+        :type directory: str
+        :param max_bytes: The size the cache is kept under
+        :type max_bytes: int
+        :param max_duration: Longer tracks are not cached, in seconds
+        :type max_duration: int
+        :param aliases: The amount of requested urls remembered
+        :type aliases: int
+        """
+        self.directory = directory
+        self.loop = loop
+        self.max_bytes = max_bytes
+        self.max_duration = max_duration
+        self.hits = 0
+        self.misses = 0
+        # key -> size, least recently used first
+        self._entries = OrderedDict()
+        self._size = 0
+        # requested url -> (key, track info)
+        self._aliases = LRUCache(aliases)
+        cache_bytes.set_function(lambda cache: cache._size, owner=self)
+        cache_hit_ratio.set_function(lambda cache: cache.hit_ratio, owner=self)
+
+    @asyncio.coroutine
+    def start(self):
+        yield from self.loop.run_in_executor(None, self._load)
+        log.info('Audio cache has %s entries, %s bytes', len(self._entries), self._size)
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @staticmethod
+    def key_for(info):
+        """
+        :param info: The track info youtube-dl extracted
+        :type info: dict
+        :rtype: str
+        """
+        extractor = info.get('extractor_key') or info.get('extractor') or 'generic'
+        return '{}-{}'.format(extractor, info['id']).replace(os.sep, '_')
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key + '.opus')
+
+    @asyncio.coroutine
+    def lookup(self, url):
+        """
+        Find the entry of an url requested before, without extracting it. Only hits are counted, a miss is
+        counted by the :meth:`get` that follows the extraction.
+
+        :return: (PacketReader, track info), or None when it is not cached
+        :rtype: tuple
+        """
+        alias = self._aliases.get(url)
+        if alias is None:
+            return None
+        key, info = alias
+        reader = yield from self._open(key)
+        if reader is None:
+            return None
+        self._record_hit(reader)
+        return reader, info
+
+    @asyncio.coroutine
+    def get(self, info, url=None):
+        """
+        :param info: The extracted track info
+        :type info: dict
+        :param url: What was requested, remembered so :meth:`lookup` finds it next time
+        :type url: str
+        :return: A reader for the cached entry, or None
+        :rtype: PacketReader
+        """
+        key = self.key_for(info)
+        if url is not None:
+            self._aliases[url] = (key, {name: info.get(name) for name in _track_info})
+        reader = yield from self._open(key)
+        if reader is None:
+            self.misses += 1
+            cache_requests.inc(labels=('miss',))
+        else:
+            self._record_hit(reader)
+        return reader
+
+    def writer(self, info):
+        """
+        Record a track into the cache while it is streamed for playing, so it is only downloaded once. Two players
+        recording the same track are harmless, the entry of the last one to finish is kept.
+
+        :param info: The extracted track info
+        :type info: dict
+        :return: The writer to give the player, None when the track is not to be cached
+        :rtype: CacheWriter
+        """
+        key = self.key_for(info)
+        if key in self._entries or info.get('is_live') or (info.get('duration') or 0) > self.max_duration:
+            return None
+        return CacheWriter(self, key, info.get('duration'), _source_bytes(info))
+
+    def _written(self, key, size):
+        """Called on the loop when a writer kept its entry"""
+        self._add(key, size)
+        log.info('Cached %s (%s bytes)', key, size)
+
+    @asyncio.coroutine
+    def _open(self, key):
+        if key not in self._entries:
+            return None
+        try:
+            reader = yield from self.loop.run_in_executor(None, self._open_entry, key)
+        except (OSError, ValueError):
+            # removed by another process sharing the directory
+            self._forget(key)
+            return None
+        if key in self._entries:
+            self._entries.move_to_end(key)
+        return reader
+
+    def _open_entry(self, key):
+        """Runs in an executor"""
+        path = self.path_for(key)
+        reader = PacketReader(path)
+        try:
+            # the mtime is the last use, so the order survives a restart
+            os.utime(path)
+        except OSError:
+            reader.close()
+            raise
+        return reader
+
+    def _record_hit(self, reader):
+        self.hits += 1
+        cache_requests.inc(labels=('hit',))
+        bytes_saved.inc(reader.source_bytes)
+
+    def _add(self, key, size):
+        self._forget(key)
+        self._entries[key] = size
+        self._size += size
+        evicted = []
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            oldest = next(iter(self._entries))
+            evicted.append(self.path_for(oldest))
+            self._forget(oldest)
+        if evicted:
+            self.loop.run_in_executor(None, _remove, evicted)
+
+    def _forget(self, key):
+        size = self._entries.pop(key, None)
+        if size is not None:
+            self._size -= size
+
+    def _load(self):
+        """Runs in an executor, the entries that were played last are the last ones in the index"""
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        with os.scandir(self.directory) as scanned:
+            for entry in scanned:
+                if entry.name.endswith('.opus'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.name[:-len('.opus')], stat.st_size))
+                elif entry.name.endswith('.tmp') and entry.stat().st_mtime < time.time() - leftover_age:
+                    # left behind by a crash, a younger one may be written by another process sharing the directory
+                    _remove((entry.path,))
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._size += size
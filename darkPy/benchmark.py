@@ -0,0 +1,176 @@
+"""
+Synthetic benchmarks for the state handling, complementing the recorded traffic replay in :mod:`darkPy.replay`.
+
+Usage: python -m darkPy.benchmark [channel_lookup|memory|startup] [--sizes 10,1000,50000]
+"""
+import argparse
+import asyncio
+import gc
+import json
+import random
+import time
+import tracemalloc
+
+from darkPy.cache import CachePolicy
+from darkPy.replay import ReplayClient
+
+
+def make_user(user_id):
+    return {'id': str(user_id), 'username': 'user{}'.format(user_id), 'discriminator': '0001', 'avatar': None}
+
+
+def make_guild(guild_id, *, channels=3, members=0, roles=1):
+    """Build a GUILD_CREATE payload, snowflakes are derived from ``guild_id`` so they are unique"""
+    base = guild_id * 1000
+    return {
+        'id': str(guild_id), 'name': 'guild{}'.format(guild_id), 'icon': None, 'splash': None,
+        'owner_id': '1', 'region': 'eu-west', 'afk_channel_id': None, 'afk_timeout': 300,
+        'verification_level': 0, 'default_message_notifications': 0, 'explicit_content_filter': 0,
+        'roles': [{'id': str(base + 900 + i), 'name': 'role{}'.format(i), 'color': 0, 'hoist': False,
+                   'position': i, 'permissions': 0, 'managed': False, 'mentionable': False}
+                  for i in range(roles)],
+        'emojis': [], 'features': [], 'mfa_level': 0, 'application_id': None, 'system_channel_id': None,
+        'large': False, 'member_count': members,
+        'members': [{'user': make_user(base + 500 + i), 'roles': [], 'joined_at': '2018-01-01T00:00:00',
+                     'deaf': False, 'mute': False} for i in range(members)],
+        'channels': [{'id': str(base + i), 'type': 2 if i == channels - 1 else 0, 'name': 'channel{}'.format(i),
+                      'position': i, 'permission_overwrites': []} for i in range(channels)],
+        'voice_states': []
+    }
+
+
+def make_message(message_id, channel_id, author_id):
+    return {
+        'id': str(message_id), 'channel_id': str(channel_id), 'content': 'hello', 'author': make_user(author_id),
+        'timestamp': '2018-01-01T00:00:00', 'edited_timestamp': None, 'tts': False, 'mention_everyone': False,
+        'mentions': [], 'mention_roles': [], 'attachments': [], 'embeds': [], 'pinned': False, 'type': 0
+    }
+
+
+def populate(guilds, loop=None, **state_options):
+    client = ReplayClient(asyncio.new_event_loop() if loop is None else loop, **state_options)
+    for guild_id in range(1, guilds + 1):
+        client.connection.parse_guild_create(make_guild(guild_id))
+    return client
+
+
+def channel_lookup(sizes, messages=20000):
+    """
+    Cost of routing a channel id to its guild and channel for a growing amount of guilds, on its own and as part
+    of handling MESSAGE_CREATE. Messages are handled with the message cache off, so its inserts are not timed.
+
+    :return: (guilds, seconds per lookup, seconds per message) for every size
+    :rtype: list
+    """
+    results = []
+    for size in sizes:
+        client = populate(size, cache_policy=CachePolicy(messages=False))
+        state = client.connection
+        rng = random.Random(size)
+        channel_ids = [rng.randint(1, size) * 1000 for _ in range(messages)]
+        payloads = [make_message(n, channel_id, 7) for n, channel_id in enumerate(channel_ids)]
+        # build the channels up front, only the lookups are timed
+        for channel_id in set(channel_ids):
+            state.get_channel(channel_id)
+        # keep the collector from walking the freshly built state while timing
+        gc.collect()
+        gc.freeze()
+        get_guild = state._get_guild_for_channel
+        get_channel = state.get_channel
+        started = time.perf_counter()
+        for channel_id in channel_ids:
+            get_guild(channel_id)
+            get_channel(channel_id)
+        lookup = time.perf_counter() - started
+        started = time.perf_counter()
+        for payload in payloads:
+            state.parse_message_create(payload)
+        handling = time.perf_counter() - started
+        gc.unfreeze()
+        results.append((size, lookup / messages, handling / messages))
+    return results
+
+
+def _state_size(guilds, **guild_options):
+    loop = asyncio.new_event_loop()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        client = ReplayClient(loop, preload_members=True)
+        for guild_id in range(1, guilds + 1):
+            # built inside the trace so whatever the state keeps of the payload is counted
+            client.connection.parse_guild_create(make_guild(guild_id, **guild_options))
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return size, client
+
+
+def memory(guilds=1000, channels=10, members=10):
+    """
+    Bytes of state kept per guild, channel and member.
+    Measured by growing one dimension at a time and dividing the difference.
+    """
+    base, _ = _state_size(guilds, channels=1, members=0, roles=1)
+    with_channels, _ = _state_size(guilds, channels=channels + 1, members=0, roles=1)
+    with_members, _ = _state_size(guilds, channels=1, members=members, roles=1)
+    return {
+        'guild': base / guilds,
+        'channel': (with_channels - base) / (guilds * channels),
+        'member': (with_members - base) / (guilds * members)
+    }
+
+
+def startup(guilds=1000, channels=20, members=20, roles=10):
+    """
+    Cost of the READY burst: time per GUILD_CREATE, and the memory kept by the state and the peak while building it
+    """
+    # decoded inside the trace like the gateway does, so whatever the state keeps of a payload is counted
+    frames = [json.dumps(make_guild(guild_id, channels=channels, members=members, roles=roles))
+              for guild_id in range(1, guilds + 1)]
+    client = ReplayClient(asyncio.new_event_loop(), preload_members=True)
+    gc.collect()
+    started = time.perf_counter()
+    for frame in frames:
+        client.connection.parse_guild_create(json.loads(frame))
+    elapsed = time.perf_counter() - started
+    # timed and traced separately, tracing slows down every allocation
+    client = ReplayClient(asyncio.new_event_loop(), preload_members=True)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        for frame in frames:
+            client.connection.parse_guild_create(json.loads(frame))
+        gc.collect()
+        kept, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'us per guild': elapsed / guilds * 1000000,
+        'kept per guild': kept / guilds,
+        'peak per guild': peak / guilds
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the synthetic state benchmarks')
+    parser.add_argument('benchmark', nargs='?', default='channel_lookup', choices=['channel_lookup', 'memory', 'startup'])
+    parser.add_argument('--sizes', default='10,100,1000,10000,50000')
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    if args.benchmark == 'channel_lookup':
+        print('{:>8} {:>16} {:>16}'.format('guilds', 'us per lookup', 'us per message'))
+        for size, lookup, handling in channel_lookup(sizes):
+            print('{:>8} {:>16.2f} {:>16.2f}'.format(size, lookup * 1000000, handling * 1000000))
+    elif args.benchmark == 'memory':
+        for kind, size in memory(sizes[-1] if len(sizes) == 1 else 1000).items():
+            print('{:>8} {:>10.0f} bytes'.format(kind, size))
+    elif args.benchmark == 'startup':
+        for name, value in startup(sizes[-1] if len(sizes) == 1 else 1000).items():
+            print('{:>16} {:>10.0f}'.format(name, value))
+
+
+if __name__ == '__main__':
+    main()
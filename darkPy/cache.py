@@ -0,0 +1,233 @@
+from collections import OrderedDict
+
+from darkPy import metrics
+
+
+class LRUCache:
+    """
+    A dict-like cache that holds at most ``maxsize`` entries, dropping the least recently used one first.
+    A ``maxsize`` of ``None`` means unbounded.
+    """
+    __slots__ = ('maxsize', '_data', 'hits', 'misses', 'evictions')
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key, default=None):
+        """Look up a value without counting it as a use"""
+        return self._data.get(key, default)
+
+    def __setitem__(self, key, value):
+        data = self._data
+        data[key] = value
+        data.move_to_end(key)
+        if self.maxsize is not None and len(data) > self.maxsize:
+            evicted = data.popitem(last=False)
+            self.evictions += 1
+            self._evicted(*evicted)
+
+    def _evicted(self, key, value):
+        """Called after ``key`` was dropped to stay within ``maxsize``"""
+        pass
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        return iter(list(self._data))
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def keys(self):
+        return self._data.keys()
+
+    def values(self):
+        return self._data.values()
+
+    def items(self):
+        return self._data.items()
+
+    def clear(self):
+        self._data.clear()
+
+
+class MessageCache:
+    """
+    Bounds the messages cached across all channels.
+    Every channel gets its own :class:`ChannelMessageCache` capped at ``max_per_channel``, while this keeps the
+    use order over all of them so the least recently used message overall is dropped past ``max_messages``.
+    """
+
+    def __init__(self, max_messages=5000, max_per_channel=100):
+        self.max_messages = max_messages
+        self.max_per_channel = max_per_channel
+        self._order = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def channel_cache(self, channel_id):
+        return ChannelMessageCache(self, channel_id, self.max_per_channel)
+
+    def __len__(self):
+        return len(self._order)
+
+    def _touch(self, key):
+        self._order.move_to_end(key)
+
+    def _added(self, key, cache):
+        order = self._order
+        order[key] = cache
+        order.move_to_end(key)
+        if self.max_messages is not None and len(order) > self.max_messages:
+            (_, message_id), oldest = order.popitem(last=False)
+            oldest._data.pop(message_id, None)
+            self.evictions += 1
+            metrics.message_cache.inc(labels=('evictions',))
+
+    def _removed(self, key):
+        self._order.pop(key, None)
+
+    def stats(self):
+        """
+        :return: The amount of cached messages, hits, misses and evictions
+        :rtype: dict
+        """
+        total = self.hits + self.misses
+        return {
+            'size': len(self._order),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / total if total else None,
+            'evictions': self.evictions
+        }
+
+
+class ChannelMessageCache(LRUCache):
+    """The messages of one channel, kept in step with the global :class:`MessageCache`"""
+    __slots__ = ('parent', 'channel_id')
+
+    def __init__(self, parent, channel_id, maxsize):
+        super().__init__(maxsize)
+        self.parent = parent
+        self.channel_id = channel_id
+
+    def get(self, key, default=None):
+        value = self._data.get(key)
+        if value is None:
+            self.parent.misses += 1
+            metrics.message_cache.inc(labels=('misses',))
+            return default
+        self._data.move_to_end(key)
+        self.parent._touch((self.channel_id, key))
+        self.parent.hits += 1
+        metrics.message_cache.inc(labels=('hits',))
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.parent._added((self.channel_id, key), self)
+
+    def _evicted(self, key, value):
+        self.parent._removed((self.channel_id, key))
+        self.parent.evictions += 1
+        metrics.message_cache.inc(labels=('evictions',))
+
+    def pop(self, key, default=None):
+        self.parent._removed((self.channel_id, key))
+        return self._data.pop(key, default)
+
+    def clear(self):
+        for key in list(self._data):
+            self.parent._removed((self.channel_id, key))
+        self._data.clear()
+
+
+class CacheDisabled(Exception):
+    """Raised when reading from a cache category that the :class:`CachePolicy` switched off"""
+    pass
+
+
+class DisabledCache:
+    """
+    Takes the place of a cache the :class:`CachePolicy` switched off.
+    Writes are ignored and every read raises :class:`CacheDisabled`, so nothing silently returns stale data.
+    """
+    __slots__ = ('category',)
+
+    def __init__(self, category):
+        self.category = category
+
+    def _fail(self, *args, **kwargs):
+        raise CacheDisabled('The {} cache is disabled by the cache policy'.format(self.category))
+
+    get = peek = __getitem__ = __contains__ = __iter__ = keys = values = items = _fail
+
+    def __setitem__(self, key, value):
+        pass
+
+    def pop(self, key, default=None):
+        return default
+
+    def clear(self):
+        pass
+
+    def __len__(self):
+        return 0
+
+    def channel_cache(self, channel_id):
+        # also stands in for a MessageCache
+        return self
+
+
+class CachePolicy:
+    """
+    Which categories :class:`darkPy.state.ConnectionState` keeps.
+    Guilds, voice channels and voice states are always cached, they are needed to join voice.
+    """
+
+    def __init__(self, *, messages=True, members=True, emojis=True, roles=True, channels=True, users=True):
+        """
+        :param messages: Cache received messages
+        :param members: Cache guild members, :meth:`ConnectionState.fetch_member` still works without it
+        :param emojis: Cache guild emojis
+        :param roles: Cache guild roles
+        :param channels: Cache channels other than voice channels, their ids are still used for routing
+        :param users: Intern users in a shared cache
+        """
+        self.messages = messages
+        self.members = members
+        self.emojis = emojis
+        self.roles = roles
+        self.channels = channels
+        self.users = users
+
+    @classmethod
+    def voice_only(cls):
+        """Only what is needed to play audio: guilds, voice channels and voice states"""
+        return cls(messages=False, members=False, emojis=False, roles=False, channels=False, users=False)
+
+    def __repr__(self):
+        return '<CachePolicy messages={0.messages} members={0.members} emojis={0.emojis} roles={0.roles} ' \
+               'channels={0.channels} users={0.users}>'.format(self)
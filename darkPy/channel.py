@@ -2,25 +2,88 @@
 from enum import Enum
 
 from darkPy import helpers
-from darkPy.user import User
+from darkPy.cache import LRUCache
+from darkPy.model import Model, snowflake
+from darkPy.user import make_user
 
 log = helpers.setup_logger()
 
-class Channel:
-    def __init__(self, data, guild):
-        for key in data:
-            if key == "recipients":
-                recipients = []
-                for userData in data[key]:
-                    user = User(userData)
-                    recipients.append(user)
-                setattr(self, key, recipients)
-            else:
-                setattr(self, key, data[key])
-        self.messages = {}
+class Channel(Model):
+    __slots__ = ('id', 'type', 'guild_id', 'position', 'permission_overwrites', 'name', 'topic', 'nsfw',
+                 'last_message_id', 'bitrate', 'user_limit', 'rate_limit_per_user', 'icon', 'owner_id',
+                 'application_id', 'parent_id', 'last_pin_timestamp', 'recipients', 'guild', 'connected_users',
+                 '_messages', '_message_cache', '_users')
+    _fields = {
+        'id': None,
+        'type': 0,
+        'guild_id': None,
+        'position': 0,
+        'permission_overwrites': (),
+        'name': None,
+        'topic': None,
+        'nsfw': False,
+        'last_message_id': None,
+        'bitrate': None,
+        'user_limit': None,
+        'rate_limit_per_user': 0,
+        'icon': None,
+        'owner_id': None,
+        'application_id': None,
+        'parent_id': None,
+        'last_pin_timestamp': None,
+        'recipients': ()
+    }
+    _snowflakes = frozenset(('id', 'guild_id', 'last_message_id', 'owner_id', 'application_id', 'parent_id'))
+
+    def __init__(self, data, guild, message_cache=None, users=None):
+        """
+        :param message_cache: The cache that bounds the messages of all channels
+        :type message_cache: darkPy.cache.MessageCache
+        :param users: The cache users are interned in
+        :type users: darkPy.user.UserCache
+        """
+        self._init_fields(data)
+        self._users = users
+        if 'recipients' in data:
+            self.recipients = [make_user(userData, users) for userData in data['recipients']]
+        # created on the first message, most channels never see one
+        self._messages = None
+        self._message_cache = message_cache
         self.guild = guild
-        if self.type == ChannelType.GUILD_VOICE.value:
-            self.connected_users = {}
+        self.connected_users = {} if self.type == ChannelType.GUILD_VOICE.value else None
+
+    def update(self, data):
+        """
+        Apply a CHANNEL_UPDATE payload in place, only the fields present in it change
+        :param data: The (partial) channel payload
+        :type data: dict
+        """
+        self._update_fields(data)
+        if 'recipients' in data:
+            self.recipients = [make_user(userData, self._users) for userData in data['recipients']]
+        if 'type' in data:
+            isVoice = self.type == ChannelType.GUILD_VOICE.value
+            if isVoice and self.connected_users is None:
+                self.connected_users = {}
+            elif not isVoice:
+                self.connected_users = None
+
+    @property
+    def messages(self):
+        if self._messages is None:
+            if self._message_cache is not None:
+                self._messages = self._message_cache.channel_cache(self.id)
+            else:
+                self._messages = LRUCache(100)
+        return self._messages
+
+    @messages.setter
+    def messages(self, messages):
+        self._messages = messages
+
+    def clear_messages(self):
+        if self._messages is not None:
+            self._messages.clear()
 
     def add_message(self, message):
         self.messages[message.id] = message
@@ -29,34 +92,31 @@ class Channel:
         return self.messages.get(message_id, None)
 
     def update_message(self, new_data):
-        message = self.get_message(new_data['id'])
+        message = self.get_message(snowflake(new_data['id']))
         if message:
-            message.update(new_data)
+            message.update(new_data, self._users)
         else:
-            pass
             from darkPy.message import Message
-            self.add_message(Message(new_data))
+            self.add_message(Message(new_data, self._users))
 
     def remove_message(self, message_id):
-        message = self.get_message(message_id)
-        if message:
-            self.messages[message_id] = None
+        self.messages.pop(message_id)
 
     def add_voice_user(self, data):
         if self.type == ChannelType.GUILD_VOICE.value:
-            self.connected_users[data['user_id']] = {
+            self.connected_users[snowflake(data['user_id'])] = {
                 'deaf': data.get('deaf', False),
                 'mute': data.get('mute', False),
                 'self_deaf': data.get('self_deaf', False),
                 'self_mute': data.get('self_mute', False)
             }
-            log.info("User {} is now in channel {}".format(data['user_id'], self.id))
+            log.debug("User %s is now in channel %s", data['user_id'], self.id)
 
     def remove_voice_user(self, user_id):
         if self.type == ChannelType.GUILD_VOICE.value:
             if self.connected_users.get(user_id, None):
                 self.connected_users.pop(user_id)
-                log.info("User {} is now removed from channel {}".format(user_id, self.id))
+                log.debug("User %s is now removed from channel %s", user_id, self.id)
 
     def contains_user(self, user_id):
         if self.type == ChannelType.GUILD_VOICE.value:
@@ -1,27 +1,79 @@
 import asyncio
+import logging
+import time
 
 from websockets import ConnectionClosed
 
-from darkPy import helpers
+from darkPy import helpers, metrics
 from darkPy.gateway import MainGateway, ResumeWebSocket
+from darkPy.model import snowflake
+from darkPy.reconnect import ReconnectManager
+from darkPy.scheduler import CommandScheduler
+from darkPy.session_store import SessionStore
+from darkPy.sounds import SoundLibrary
+from darkPy.voice_pool import VoicePool
+from darkPy.watchdog import LoopWatchdog
+from darkPy.encoding import EncoderPool
+from darkPy.audio_cache import AudioCache
 from darkPy.state import ConnectionState
 from darkPy.voice_client import VoiceClient
 from darkPy.channel import Channel, ChannelType
 
 log = helpers.setup_logger()
+# any message starting with ! ends up in the log as an unknown command
+_command_sampler = helpers.LogSampler(20)
 
 
 class Client:
 
-    def __init__(self, *, loop=None):
+    def __init__(self, *, loop=None, max_concurrent_reconnects=1, debug=True, metrics_port=None,
+                 member_cache_size=1000, max_messages=5000, max_messages_per_channel=100, cache_policy=None,
+                 session_file=None, session_save_interval=30.0, max_commands_in_flight=8,
+                 sound_directory=None, voice_idle_timeout=300.0, max_idle_voice_clients=10,
+                 watchdog_threshold=0.25, encoder_processes=None, audio_cache_directory=None,
+                 audio_cache_bytes=1 << 30):
         self.ws = None
         self.loop = asyncio.get_event_loop() if loop is None else loop
-        self.loop.set_debug(True)
+        # asyncio debug mode is expensive, turn it off in production
+        self.loop.set_debug(debug)
         self.token = ""
 
-        self.command_listeners = {}
+        # shared by the main gateway and every voice connection
+        self.reconnects = ReconnectManager(loop=self.loop, max_concurrent=max_concurrent_reconnects)
 
-        self.connection = ConnectionState(self, loop=self.loop)
+        self.command_listeners = {}
+        # runs the commands one at a time per guild
+        self.commands = CommandScheduler(loop=self.loop, max_in_flight=max_commands_in_flight)
+        self.event_listeners = {}
+
+        # persisting the session lets a restarted process RESUME instead of IDENTIFY
+        self.session_store = SessionStore(session_file) if session_file is not None else None
+        self.session_save_interval = session_save_interval
+
+        # the clips that can be played by name, loaded when the client starts
+        self.sounds = SoundLibrary(sound_directory, loop=self.loop) if sound_directory is not None else None
+
+        # voice connections stay open after a clip, so the next one starts without joining again
+        self.voice_pool = VoicePool(self, idle_timeout=voice_idle_timeout, max_idle=max_idle_voice_clients)
+
+        # encode audio in worker processes instead of the player threads, which share the GIL with the loop
+        self.encoder_pool = EncoderPool(encoder_processes) if encoder_processes else None
+
+        # remote audio is kept on disk as Opus packets, so playing it again needs no download or encoding
+        self.audio_cache = None
+        if audio_cache_directory is not None:
+            self.audio_cache = AudioCache(audio_cache_directory, loop=self.loop, max_bytes=audio_cache_bytes)
+
+        self.metrics = metrics.registry
+        # reports code blocking the loop, None to turn it off
+        self.watchdog = LoopWatchdog(self.loop, threshold=watchdog_threshold) if watchdog_threshold else None
+        self.metrics_server = None
+        if metrics_port is not None:
+            self.metrics_server = metrics.MetricsServer(self.metrics, port=metrics_port, loop=self.loop)
+
+        self.connection = ConnectionState(self, loop=self.loop, member_cache_size=member_cache_size,
+                                          max_messages=max_messages, max_messages_per_channel=max_messages_per_channel,
+                                          cache_policy=cache_policy)
         self._closed = asyncio.Event(loop=self.loop)
 
         if VoiceClient.warn_nacl:
@@ -45,11 +97,43 @@ class Client:
         finally:
             self.loop.close()
 
-    def add_command(self, name, func):
+    def add_command(self, name, func, **options):
+        """
+        Call ``func`` with the arguments and the message for every ``!name`` message
+        :param options: How the command is scheduled, see :class:`darkPy.scheduler.CommandOptions`
+        """
         self.command_listeners[name] = func
+        if options:
+            self.commands.configure(name, **options)
+
+    def add_listener(self, event, func):
+        """
+        Call ``func`` with the event data every time ``event`` is dispatched.
+        Listeners run synchronously on the event loop, so they should be cheap.
+        :type event: str
+        :type func: callable
+        """
+        self.event_listeners.setdefault(event, []).append(func)
+
+    def remove_listener(self, event, func):
+        listeners = self.event_listeners.get(event, [])
+        if func in listeners:
+            listeners.remove(func)
 
     @asyncio.coroutine
     def start(self, token):
+        self.loop.create_task(metrics.monitor_loop_lag(self.loop))
+        if self.watchdog is not None:
+            self.watchdog.start()
+        if self.encoder_pool is not None:
+            self.encoder_pool.start()
+        if self.metrics_server is not None:
+            yield from self.metrics_server.start()
+        if self.sounds is not None:
+            # analysing new clips can take long, it goes on while connecting
+            self.sounds.start()
+        if self.audio_cache is not None:
+            yield from self.audio_cache.start()
         yield from self.login(token)
         yield from self.connect()
 
@@ -59,7 +143,10 @@ class Client:
 
     @asyncio.coroutine
     def connect(self):
-        self.ws = yield from MainGateway.from_client(self)
+        resume = self._restore_session()
+        self.ws = yield from MainGateway.from_client(self, resume=resume)
+        if self.session_store is not None:
+            self.loop.create_task(self._save_session_periodically())
 
         while not self._is_closed:
             try:
@@ -78,26 +165,86 @@ class Client:
         Close the websocket connection
         :returns:``None``
         """
-        if self._closed:
+        if self._is_closed:
             return
+        if self.session_store is not None:
+            yield from self.save_session()
         if self.ws is not None and self.ws.open:
-            yield from self.ws.close()
+            # closing with 1000 ends the session on discord's side, so keep it resumable when persisting it
+            yield from self.ws.close(4000 if self.session_store is not None else 1000)
+        if self.metrics_server is not None:
+            yield from self.metrics_server.close()
+        if self.sounds is not None:
+            self.sounds.stop()
+        self.voice_pool.clear()
+        if self.watchdog is not None:
+            self.watchdog.stop()
+        if self.encoder_pool is not None:
+            yield from self.loop.run_in_executor(None, self.encoder_pool.stop)
 
         self._closed.set()
 
+    def _restore_session(self):
+        if self.session_store is None:
+            return False
+        session = self.session_store.load()
+        if session is None or not session.get('snapshot'):
+            return False
+        try:
+            self.connection.restore(session)
+        except Exception as e:
+            log.warning('Could not restore the stored session: %r', e)
+            self.connection.clear()
+            return False
+        if session.get('gateway'):
+            helpers.set_gateway(session['gateway'])
+        log.info('Restored session %s at sequence %s, trying to RESUME', session['session_id'], session['sequence'])
+        return True
+
+    @asyncio.coroutine
+    def save_session(self):
+        """Write the current session and a state snapshot to the session file"""
+        state = self.connection
+        if self.session_store is None or state.session_id is None:
+            return
+        # the snapshot has to be taken on the loop, encoding and writing it are moved off it
+        snapshot = state.snapshot()
+        gateway = getattr(self.ws, 'gateway', None)
+        try:
+            yield from self.loop.run_in_executor(None, self._write_session, state.session_id, state.sequence,
+                                                 gateway, snapshot)
+        except OSError as e:
+            log.warning('Could not save the session: %r', e)
+
+    def _write_session(self, session_id, sequence, gateway, snapshot):
+        self.session_store.save(session_id, sequence, gateway, ConnectionState.encode_snapshot(snapshot))
+
+    @asyncio.coroutine
+    def _save_session_periodically(self):
+        while not self._is_closed:
+            yield from asyncio.sleep(self.session_save_interval, loop=self.loop)
+            yield from self.save_session()
+
     @property
     def _is_closed(self):
         return self._closed.is_set()
 
     def dispatch(self, event, data):
+        listeners = self.event_listeners.get(event)
+        if listeners:
+            for listener in listeners:
+                listener(data)
         if event == 'message_create':
             if data.content.startswith('!'):
                 components = data.content.split(' ')
                 command_name = components[0][1:]
-                if self.command_listeners.get(command_name, None):
-                    self.loop.create_task(self.command_listeners[command_name](components, data))
-                else:
-                    log.info('Unknown command {}'.format(command_name))
+                listener = self.command_listeners.get(command_name)
+                if listener is not None:
+                    guild = self.connection._get_guild_for_channel(data.channel_id)
+                    key = guild.id if guild is not None else data.channel_id
+                    self.commands.submit(command_name, listener, components, data, key)
+                elif log.isEnabledFor(logging.DEBUG) and _command_sampler():
+                    log.debug('Unknown command %s', command_name)
 
     @asyncio.coroutine
     def join_voice_channel(self, channel):
@@ -122,19 +269,21 @@ class Client:
         log.info('attempting to join voice channel {0.name}'.format(channel))
 
         def session_id_found(d):
-            user_id = d.get('user_id')
-            guild_id = d.get('guild_id')
+            user_id = snowflake(d.get('user_id'))
+            guild_id = snowflake(d.get('guild_id'))
             return user_id == self.user_id and guild_id == guild.id
 
         # register the futures for waiting
         session_id_future = self.ws.wait_for('VOICE_STATE_UPDATE', session_id_found)
-        voice_data_future = self.ws.wait_for('VOICE_SERVER_UPDATE', lambda d: d.get('guild_id') == guild.id)
+        voice_data_future = self.ws.wait_for('VOICE_SERVER_UPDATE', lambda d: snowflake(d.get('guild_id')) == guild.id)
 
+        started = time.perf_counter()
         yield from self.ws.voice_state(guild.id, channel.id)
 
         try:
-            session_id_data = yield from asyncio.wait_for(session_id_future, timeout=10.0, loop=self.loop)
-            data = yield from asyncio.wait_for(voice_data_future, timeout=10.0, loop=self.loop)
+            # discord sends both in either order, wait for them together
+            session_id_data, data = yield from asyncio.wait_for(
+                asyncio.gather(session_id_future, voice_data_future, loop=self.loop), timeout=10.0, loop=self.loop)
         except asyncio.TimeoutError as e:
             yield from self.ws.voice_state(guild.id, None, self_mute=True)
             raise e
@@ -145,10 +294,14 @@ class Client:
             'data': data,
             'loop': self.loop,
             'session_id': session_id_data.get('session_id'),
-            'main_ws': self.ws
+            'main_ws': self.ws,
+            'reconnects': self.reconnects,
+            'encoder_pool': self.encoder_pool,
+            'audio_cache': self.audio_cache
         }
 
         voice = VoiceClient(**kwargs)
+        voice.record_phase('gateway', time.perf_counter() - started)
         try:
             yield from voice.connect()
         except asyncio.TimeoutError as e:
@@ -187,14 +340,24 @@ class Client:
     def get_channel(self, channel_id):
         return self.connection.get_channel(channel_id)
 
+    @asyncio.coroutine
+    def fetch_member(self, guild, user_id):
+        """
+        Retrieve a member of a guild, requesting it from discord if it is not cached
+        :type guild: darkPy.guild.Guild
+        :type user_id: int
+        :rtype: darkPy.guild.Member
+        """
+        return (yield from self.connection.fetch_member(guild.id, user_id))
+
     def logout(self):
         yield from self.close()
 
     def get_guild_for_channel(self, channel):
         """
 
-        :param channel: The channel object to retrieve to guild for
+        :param channel: The channel object or channel id to retrieve to guild for
         :type channel: Channel
         """
-        return self.connection._get_guild_for_channel(channel.id)
+        return self.connection._get_guild_for_channel(getattr(channel, 'id', channel))
 
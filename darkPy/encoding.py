@@ -0,0 +1,247 @@
+import itertools
+import mmap
+import multiprocessing
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+
+from darkPy import helpers
+
+log = helpers.setup_logger()
+
+# read and write counters at the start of a ring, then the slots: data length followed by the data
+_counters = struct.Struct('<QQ')
+_length = struct.Struct('<I')
+
+# an Opus packet of a 20ms frame is never larger than this
+max_packet_size = 4000
+
+
+class SharedRing:
+    """
+    Fixed size single producer, single consumer ring buffer in a memory mapped file.
+
+    Both sides map the same file, in ``/dev/shm`` when available, so the data never goes through a pipe. The
+    producer only moves the write counter and the consumer only moves the read counter.
+    """
+
+    def __init__(self, path, slots, slot_size, *, create=False):
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self._stride = _length.size + slot_size
+        size = _counters.size + slots * self._stride
+        if create:
+            with open(path, 'wb') as file:
+                file.truncate(size)
+        with open(path, 'r+b') as file:
+            self._map = mmap.mmap(file.fileno(), size)
+
+    def __len__(self):
+        written, read = _counters.unpack_from(self._map, 0)
+        return written - read
+
+    def put(self, data):
+        """
+        :return: False when the ring is full
+        :rtype: bool
+        """
+        written, read = _counters.unpack_from(self._map, 0)
+        if written - read >= self.slots:
+            return False
+        if len(data) > self.slot_size:
+            raise ValueError('{} bytes do not fit in a slot of {}'.format(len(data), self.slot_size))
+        offset = _counters.size + (written % self.slots) * self._stride
+        _length.pack_into(self._map, offset, len(data))
+        self._map[offset + _length.size:offset + _length.size + len(data)] = data
+        # only now the consumer can see the slot
+        struct.pack_into('<Q', self._map, 0, written + 1)
+        return True
+
+    def get(self):
+        """
+        :return: The oldest item, or None when the ring is empty
+        :rtype: bytes
+        """
+        written, read = _counters.unpack_from(self._map, 0)
+        if written == read:
+            return None
+        offset = _counters.size + (read % self.slots) * self._stride
+        length, = _length.unpack_from(self._map, offset)
+        data = self._map[offset + _length.size:offset + _length.size + length]
+        struct.pack_into('<Q', self._map, 8, read + 1)
+        return data
+
+    def close(self):
+        self._map.close()
+
+
+def _worker(tasks):
+    """Encodes the frames of the streams assigned to this process, runs in a worker process"""
+    from darkPy import opus
+
+    streams = {}
+    while True:
+        task = tasks.get()
+        kind, stream_id = task[0], task[1]
+        if kind == 'frames':
+            stream = streams.get(stream_id)
+            if stream is None:
+                continue
+            pcm, packets, encoder = stream
+            # drain everything queued, a notification may cover several frames
+            while True:
+                data = pcm.get()
+                if data is None:
+                    break
+                packets.put(encoder.encode(data, encoder.samples_per_frame))
+        elif kind == 'open':
+            _, _, pcm_path, packet_path, slots, frame_size, sampling_rate, channels = task
+            pcm = SharedRing(pcm_path, slots, frame_size)
+            packets = SharedRing(packet_path, slots, max_packet_size)
+            streams[stream_id] = (pcm, packets, opus.Encoder(sampling_rate, channels))
+        elif kind == 'close':
+            stream = streams.pop(stream_id, None)
+            if stream is not None:
+                for ring in stream[:2]:
+                    ring.close()
+                    os.unlink(ring.path)
+        elif kind == 'stop':
+            return
+
+
+class PooledStream:
+    """The rings of one player, PCM frames go in and Opus packets come out in the same order"""
+
+    def __init__(self, pool, stream_id, worker, pcm, packets):
+        self.pool = pool
+        self.id = stream_id
+        self.worker = worker
+        self.pcm = pcm
+        self.packets = packets
+        # frames handed to the worker that did not come back yet, at most the amount of slots
+        self.pending = 0
+
+    @property
+    def depth(self):
+        return self.pcm.slots
+
+    def submit(self, pcm):
+        """
+        Queue a PCM frame for encoding
+        :return: False when the ring is full
+        :rtype: bool
+        """
+        if not self.pcm.put(pcm):
+            return False
+        self.pending += 1
+        self.pool._tasks[self.worker].put(('frames', self.id))
+        return True
+
+    def result(self, timeout):
+        """
+        Wait for the packet of the oldest submitted frame, called from the player thread
+        :return: The Opus packet, or None when it was not encoded within ``timeout`` seconds
+        :rtype: bytes
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            packet = self.packets.get()
+            if packet is not None:
+                self.pending -= 1
+                return packet
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(0.001)
+
+    def close(self):
+        self.pcm.close()
+        self.packets.close()
+        self.pool._close(self)
+
+
+class EncoderPool:
+    """
+    Worker processes that encode PCM to Opus, so the encoding of all guilds is not limited to one core.
+
+    Every stream is pinned to one worker, an Opus encoder keeps state between frames. The frames and packets go
+    through :class:`SharedRing` buffers, only a short notification per frame goes through a queue.
+    """
+
+    def __init__(self, processes=None, *, slots=16):
+        """
+        :param processes: The amount of worker processes, the amount of cores by default
+        :type processes: int
+        :param slots: The amount of frames a stream can have in flight, 20ms each
+        :type slots: int
+        """
+        self.processes = processes or os.cpu_count() or 1
+        self.slots = slots
+        self._context = multiprocessing.get_context('spawn')
+        self._tasks = []
+        self._workers = []
+        self._load = []
+        # streams are opened on the loop and closed from the player threads
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._directory = None
+
+    def start(self):
+        shm = '/dev/shm'
+        self._directory = tempfile.mkdtemp(prefix='darkpy-', dir=shm if os.path.isdir(shm) else None)
+        for _ in range(self.processes):
+            tasks = self._context.Queue()
+            worker = self._context.Process(target=_worker, args=(tasks,), name='darkPy encoder', daemon=True)
+            worker.start()
+            self._tasks.append(tasks)
+            self._workers.append(worker)
+            self._load.append(0)
+        log.info('Started %s encoder processes', self.processes)
+
+    def stop(self):
+        """Waits up to a second per worker to exit, run it in an executor from the event loop"""
+        with self._lock:
+            tasks, workers = self._tasks, self._workers
+            self._tasks = []
+            self._workers = []
+            self._load = []
+        for queue in tasks:
+            queue.put(('stop', None))
+        for worker in workers:
+            worker.join(timeout=1.0)
+            if worker.is_alive():
+                worker.terminate()
+        if self._directory is not None:
+            shutil.rmtree(self._directory, ignore_errors=True)
+            self._directory = None
+
+    def open(self, encoder):
+        """
+        Create a stream encoded with the same settings as ``encoder``
+        :type encoder: darkPy.opus.Encoder
+        :rtype: PooledStream
+        """
+        stream_id = next(self._ids)
+        with self._lock:
+            worker = self._load.index(min(self._load))
+            self._load[worker] += 1
+            tasks = self._tasks[worker]
+        pcm_path = os.path.join(self._directory, '{}.pcm'.format(stream_id))
+        packet_path = os.path.join(self._directory, '{}.opus'.format(stream_id))
+        pcm = SharedRing(pcm_path, self.slots, encoder.frame_size, create=True)
+        packets = SharedRing(packet_path, self.slots, max_packet_size, create=True)
+        tasks.put(('open', stream_id, pcm_path, packet_path, self.slots, encoder.frame_size,
+                   encoder.sampling_rate, encoder.channels))
+        return PooledStream(self, stream_id, worker, pcm, packets)
+
+    def _close(self, stream):
+        with self._lock:
+            if stream.worker >= len(self._tasks):
+                return
+            self._load[stream.worker] -= 1
+            tasks = self._tasks[stream.worker]
+        # the worker removes the files, it may not have opened them yet
+        tasks.put(('close', stream.id))
@@ -1,5 +1,6 @@
 import asyncio
 import json
+import logging
 import ssl
 import struct
 import sys
@@ -10,9 +11,12 @@ from collections import namedtuple
 
 import websockets
 
-from darkPy import helpers
+from darkPy import helpers, metrics
+from darkPy.outbound import SendQueue, PRIORITY_HEARTBEAT, PRIORITY_NORMAL, PRIORITY_SESSION
 
 log = helpers.setup_logger()
+_event_sampler = helpers.LogSampler(20)
+_voice_sampler = helpers.LogSampler(5)
 
 
 @asyncio.coroutine
@@ -31,6 +35,9 @@ class ResumeWebSocket(Exception):
     pass
 
 
+# Errors after which (re)connecting is worth another try
+_retryable_errors = (asyncio.TimeoutError, OSError, ResumeWebSocket, websockets.exceptions.InvalidHandshake)
+
 EventListener = namedtuple('EventListener', 'predicate event result future')
 
 
@@ -46,6 +53,7 @@ class KeepAliveHandler(threading.Thread):
         self.msg = "Keeping websocket alive with sequence {0[d]}"
         self._stop_ev = threading.Event()
         self._last_ack = time.time()
+        self._last_send = None
 
     def run(self):
         while not self._stop_ev.wait(self.interval):
@@ -63,7 +71,9 @@ class KeepAliveHandler(threading.Thread):
                     return
 
             data = self.get_payload()
-            log.debug(self.msg.format(data))
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug(self.msg.format(data))
+            self._last_send = time.time()
             coro = self.ws.send_as_json(data)
             f = asyncio.run_coroutine_threadsafe(coro, loop=self.ws.loop)
             try:
@@ -82,6 +92,9 @@ class KeepAliveHandler(threading.Thread):
 
     def ack(self):
         self._last_ack = time.time()
+        if self._last_send is not None:
+            metrics.heartbeat_rtt.observe(self._last_ack - self._last_send)
+            self._last_send = None
 
 
 class VoiceKeepAliveHandler(KeepAliveHandler):
@@ -90,7 +103,8 @@ class VoiceKeepAliveHandler(KeepAliveHandler):
         self.msg = 'Keeping voice websocket alive with timestamp {0[d]}'
 
     def get_payload(self):
-        self.ack()
+        # the voice gateway ACKs are not handled, so treat every beat as acknowledged
+        self._last_ack = time.time()
         return {
             'op': self.ws.HEARTBEAT,
             'd': int(time.time() * 1000)
@@ -122,45 +136,93 @@ class MainGateway(websockets.client.WebSocketClientProtocol):
         self._dispatch_listeners = []
         # the keep alive
         self._keep_alive = None
+        # whether the last handshake resumed the previous session
+        self.session_resumed = False
+        # outbound payloads, created once the loop is known
+        self._send_queue = None
 
     @classmethod
     @asyncio.coroutine
     def from_client(cls, client, *, resume=False):
-        gateway = helpers.get_gateway()
-        try:
-            ws = yield from asyncio.wait_for(_ensure_coroutine_connect(gateway, loop=client.loop, klass=cls),timeout=60, loop=client.loop)
-        except asyncio.TimeoutError:
-            log.warn('Timeout while waiting for client connect')
-            return (yield from cls.from_client(client, resume=resume))
+        """
+        Connect to the gateway, retrying with backoff until it succeeds.
+        When ``resume`` is set and we still have a session, RESUME is tried before falling back to IDENTIFY.
+        """
+        manager = client.reconnects
+        backoff = manager.new_backoff()
+        started = time.monotonic()
+        while True:
+            resume = resume and client.connection.session_id is not None
+            manager.record_attempt()
+            with (yield from manager.semaphore):
+                try:
+                    ws = yield from cls._connect(client, resume=resume)
+                except _retryable_errors as e:
+                    log.warning('Could not connect to the gateway: {!r}'.format(e))
+                    ws = None
+
+            if ws is not None:
+                if resume:
+                    resumed = ws.session_resumed
+                    manager.record_resume(resumed)
+                    if not resumed:
+                        log.warning('RESUME failure, fell back to IDENTIFY')
+                latency = manager.record_connected(started, 'gateway')
+                log.info('Gateway connected in {:.2f}s (resume ratio: {})'.format(latency, manager.resume_ratio))
+                return ws
+
+            # The cached gateway might be stale, look it up again on the next attempt
+            helpers.invalidate_gateway()
+            delay = backoff.delay()
+            log.info('Reconnecting to the gateway in {:.2f}s (attempt {})'.format(delay, backoff.attempts))
+            yield from asyncio.sleep(delay, loop=client.loop)
+
+    @classmethod
+    @asyncio.coroutine
+    def _connect(cls, client, *, resume=False):
+        gateway = yield from helpers.get_gateway_async(client.loop, client.token)
+        ws = yield from asyncio.wait_for(_ensure_coroutine_connect(gateway, loop=client.loop, klass=cls),timeout=60, loop=client.loop)
         ws.token = client.token
         ws.gateway = gateway
         ws.loop = client.loop
         ws._connection = client.connection
         ws._dispatch = client.dispatch
+        ws._send_queue = SendQueue(ws._send_json_now, loop=client.loop, connection='main')
+        ws._send_queue.start()
 
         client.connection._update_references(ws)
 
         log.info('Created websocket connected to {}'.format(gateway))
         try:
             yield from asyncio.wait_for(ws.poll_event(), timeout=60, loop=client.loop)
-        except asyncio.TimeoutError:
+        except (asyncio.TimeoutError, ResumeWebSocket):
             log.warning("timed out waiting for HELLO")
             yield from ws.close(1001)
+            raise
 
         if not resume:
             yield from ws.identify()
             log.info('sent the identify payload to create the websocket')
             return ws
 
+        resumed = ws.wait_for('RESUMED', lambda d: True)
+        identified = ws.wait_for('READY', lambda d: True)
         yield from ws.resume()
         log.info('sent the resume payload to create the websocket')
         try:
-            yield from ws.ensure_open()
-        except websockets.exceptions.ConnectionClosed:
-            log.warning('RESUME failure')
-            return (yield from cls.from_client(client))
-        else:
-            return ws
+            # An invalidated session makes us IDENTIFY, so either of these ends the handshake
+            while not (resumed.done() or identified.done()):
+                yield from asyncio.wait_for(ws.poll_event(), timeout=60, loop=client.loop)
+        except BaseException:
+            if ws.open:
+                yield from ws.close(1001)
+            raise
+        finally:
+            resumed.cancel()
+            identified.cancel()
+
+        ws.session_resumed = resumed.done() and not resumed.cancelled()
+        return ws
 
     def wait_for(self, event, predicate, result=None):
         """Waits for aDISPATCH'd event that meets the predicate."""
@@ -208,7 +270,8 @@ class MainGateway(websockets.client.WebSocketClientProtocol):
                     'device': 'darkpy'
                 },
                 'compress': True,
-                'large_threshold': 250,
+                # Members are requested on demand, so keep the offline members out of GUILD_CREATE
+                'large_threshold': 50,
                 'v': 3
             }
         }
@@ -226,7 +289,8 @@ class MainGateway(websockets.client.WebSocketClientProtocol):
         msg = json.loads(msg)
         state = self._connection
 
-        log.debug("Websocket event {}".format(msg))
+        if log.isEnabledFor(logging.DEBUG) and _event_sampler():
+            log.debug("Websocket event %s", msg)
         self._dispatch('socket_response', msg)
 
         op = msg.get('op')
@@ -262,16 +326,18 @@ class MainGateway(websockets.client.WebSocketClientProtocol):
                 raise ResumeWebSocket()
 
             state.sequence = None
-            state.sequence_id = None
+            state.session_id = None
 
             yield from self.identify()
             return
 
         if op != self.DISPATCH:
-            log.info('Unhandled op {}'.format(op))
+            if log.isEnabledFor(logging.DEBUG) and _event_sampler():
+                log.debug('Unhandled op %s', op)
             return
 
         event = msg.get('t')
+        metrics.gateway_events.inc(labels=(event,))
         is_ready = event == 'READY'
 
         if is_ready:
@@ -284,7 +350,9 @@ class MainGateway(websockets.client.WebSocketClientProtocol):
         try:
             func = getattr(self._connection, parser)
         except AttributeError:
-            log.info('Unhandled event {}'.format(event))
+            # PRESENCE_UPDATE and TYPING_START end up here, one log line each would flood the log
+            if log.isEnabledFor(logging.DEBUG) and _event_sampler():
+                log.debug('Unhandled event %s', event)
         else:
             func(data)
 
@@ -318,8 +386,8 @@ class MainGateway(websockets.client.WebSocketClientProtocol):
         payload = {
             'op': self.VOICE_STATE,
             'd': {
-                'guild_id': guild_id,
-                'channel_id': channel_id,
+                'guild_id': str(guild_id),
+                'channel_id': str(channel_id) if channel_id is not None else None,
                 'self_mute': self_mute,
                 'self_deaf': self_deaf
             }
@@ -331,12 +399,55 @@ class MainGateway(websockets.client.WebSocketClientProtocol):
         if channel_id is None:
             self._connection._remove_voice_client(guild_id)
 
+    @asyncio.coroutine
+    def request_members(self, guild_id, *, user_ids=None, query='', limit=0, nonce=None):
+        payload = {
+            'op': self.REQUEST_MEMBERS,
+            'd': {
+                'guild_id': str(guild_id),
+                'limit': limit
+            }
+        }
+        if user_ids is not None:
+            payload['d']['user_ids'] = [str(user_id) for user_id in user_ids]
+        else:
+            payload['d']['query'] = query
+        if nonce is not None:
+            payload['d']['nonce'] = nonce
+
+        yield from self.send_as_json(payload)
+
     @asyncio.coroutine
     def _can_handle_close(self, code):
         return code not in (1000, 4004, 4010, 4011)
 
     @asyncio.coroutine
     def send_as_json(self, msg):
+        """
+        Queue a payload and wait until it is written.
+        Heartbeats skip the queue line, VOICE_STATE and PRESENCE updates replace a still queued one.
+        """
+        if self._send_queue is None:
+            yield from self._send_json_now(msg)
+            return
+
+        op = msg.get('op')
+        key = None
+        if op == self.HEARTBEAT:
+            priority = PRIORITY_HEARTBEAT
+        elif op in (self.IDENTIFY, self.RESUME):
+            priority = PRIORITY_SESSION
+        else:
+            priority = PRIORITY_NORMAL
+            if op == self.VOICE_STATE:
+                key = (op, msg['d']['guild_id'])
+            elif op == self.PRESENCE:
+                key = (op,)
+
+        yield from self._send_queue.put(msg, priority=priority, key=key)
+
+    @asyncio.coroutine
+    def _send_json_now(self, msg):
         try:
             yield from super().send(helpers.to_json(msg))
         except websockets.exceptions.ConnectionClosed as e:
@@ -347,6 +458,8 @@ class MainGateway(websockets.client.WebSocketClientProtocol):
     def close_connection(self):
         if self._keep_alive:
             self._keep_alive.stop()
+        if self._send_queue is not None:
+            self._send_queue.stop()
 
         yield from super().close_connection()
 
@@ -360,13 +473,40 @@ class VoiceGateway(websockets.client.WebSocketClientProtocol):
     SPEAKING = 5
     HELLO = 8
 
+    IP_DISCOVERY_ATTEMPTS = 3
+    IP_DISCOVERY_TIMEOUT = 1.0
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.max_size = None
         self._keep_alive = None
+        self._send_queue = None
 
     @asyncio.coroutine
     def send_as_json(self, data):
+        """
+        Queue a payload and wait until it is written.
+        Heartbeats skip the queue line, a SPEAKING update replaces a still queued one.
+        """
+        if self._send_queue is None:
+            yield from self._send_json_now(data)
+            return
+
+        op = data.get('op')
+        key = None
+        if op == self.HEARTBEAT:
+            priority = PRIORITY_HEARTBEAT
+        elif op in (self.IDENTIFY, self.SELECT_PROTOCOL):
+            priority = PRIORITY_SESSION
+        else:
+            priority = PRIORITY_NORMAL
+            if op == self.SPEAKING:
+                key = (op,)
+
+        yield from self._send_queue.put(data, priority=priority, key=key)
+
+    @asyncio.coroutine
+    def _send_json_now(self, data):
         yield from self.send(helpers.to_json(data))
 
     @classmethod
@@ -376,16 +516,32 @@ class VoiceGateway(websockets.client.WebSocketClientProtocol):
 
         gateway = "wss://" + client.endpoint + "?v=3"
         log.debug("Voice websocket gateway is: {}".format(gateway))
-        try:
-            ws = yield from asyncio.wait_for(
-                _ensure_coroutine_connect(gateway, loop=client.loop, klass=cls),
-                timeout=60, loop=client.loop)
-        except asyncio.TimeoutError:
-            log.warning("timed out waiting for voice client connect")
-            return (yield from cls.from_client(client))
+        manager = client.reconnects
+        backoff = manager.new_backoff()
+        started = time.monotonic()
+        while True:
+            manager.record_attempt()
+            # not limited by the semaphore, that paces the main gateway IDENTIFYs and would make every guild
+            # wait for one slow voice server
+            try:
+                ws = yield from asyncio.wait_for(
+                    _ensure_coroutine_connect(gateway, loop=client.loop, klass=cls),
+                    timeout=60, loop=client.loop)
+                break
+            except _retryable_errors as e:
+                log.warning("could not connect the voice websocket: {!r}".format(e))
+
+            delay = backoff.delay()
+            log.info('Reconnecting the voice websocket in {:.2f}s (attempt {})'.format(delay, backoff.attempts))
+            yield from asyncio.sleep(delay, loop=client.loop)
+
+        latency = manager.record_connected(started, 'voice')
+        log.info('Voice websocket connected in {:.2f}s'.format(latency))
 
         ws.gateway =gateway
         ws._connection = client
+        ws._send_queue = SendQueue(ws._send_json_now, loop=client.loop, connection='voice')
+        ws._send_queue.start()
 
         # waiting for HELLO packet
         try:
@@ -397,8 +553,8 @@ class VoiceGateway(websockets.client.WebSocketClientProtocol):
         identify = {
             'op': cls.IDENTIFY,
             'd': {
-                'server_id': client.guild_id,
-                'user_id': client.user.id,
+                'server_id': str(client.guild_id),
+                'user_id': str(client.user.id),
                 'session_id': client.session_id,
                 'token': client.token
             }
@@ -410,7 +566,8 @@ class VoiceGateway(websockets.client.WebSocketClientProtocol):
 
     @asyncio.coroutine
     def received_message(self, msg):
-        log.debug('Voice websocket frame received: {}'.format(msg))
+        if log.isEnabledFor(logging.DEBUG) and _voice_sampler():
+            log.debug('Voice websocket frame received: %s', msg)
         op = msg.get('op')
         data = msg.get('d')
 
@@ -430,8 +587,18 @@ class VoiceGateway(websockets.client.WebSocketClientProtocol):
         state.voice_port = data.get('port')
         packet = bytearray(70)
         struct.pack_into('>I', packet, 0, state.ssrc)
-        state.socket.sendto(packet, (state.endpoint_ip, state.voice_port))
-        recv = yield from self.loop.sock_recv(state.socket, 70)
+        # UDP, so the request or the answer can get lost, ask again instead of waiting forever
+        for attempt in range(1, self.IP_DISCOVERY_ATTEMPTS + 1):
+            state.socket.sendto(packet, (state.endpoint_ip, state.voice_port))
+            try:
+                recv = yield from asyncio.wait_for(self.loop.sock_recv(state.socket, 70),
+                                                   timeout=self.IP_DISCOVERY_TIMEOUT, loop=self.loop)
+                break
+            except asyncio.TimeoutError:
+                log.warning('No IP discovery answer from %s (attempt %s)', state.endpoint_ip, attempt)
+        else:
+            helpers.invalidate_host(state.endpoint)
+            raise asyncio.TimeoutError('IP discovery failed')
         log.debug('reveived packet in initial_connection: {}'.format(recv))
 
         # the ip is ascii starting at the 4th byte and ending at the first null
@@ -445,6 +612,7 @@ class VoiceGateway(websockets.client.WebSocketClientProtocol):
 
         log.debug('detected ip: {0.ip} port: {0.port}'.format(state))
         yield from self.select_protocol(state.ip, state.port)
+        state.phase_done('ip_discovery')
         log.info('selected the voice protocol for use')
 
     @asyncio.coroutine
@@ -495,5 +663,7 @@ class VoiceGateway(websockets.client.WebSocketClientProtocol):
     def close_connection(self):
         if self._keep_alive:
             self._keep_alive.stop()
+        if self._send_queue is not None:
+            self._send_queue.stop()
 
         yield from super().close_connection()
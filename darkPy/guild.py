@@ -1,129 +1,488 @@
-from darkPy.channel import Channel
-from darkPy.user import User
+import json
 
+from darkPy.cache import CachePolicy, DisabledCache, LRUCache
+from darkPy.channel import Channel, ChannelType
+from darkPy.model import Model, snowflake
+from darkPy.user import make_user
 
-class Role:
-    def __init__(self, data):
-        for key in data:
-            setattr(self, key, data[key])
 
+class Role(Model):
+    __slots__ = ('id', 'name', 'color', 'hoist', 'position', 'permissions', 'managed', 'mentionable')
+    _fields = {
+        'id': None,
+        'name': None,
+        'color': 0,
+        'hoist': False,
+        'position': 0,
+        'permissions': 0,
+        'managed': False,
+        'mentionable': False
+    }
+    _snowflakes = frozenset(('id',))
 
-class Attachment:
     def __init__(self, data):
-        for key in data:
-            setattr(self, key, data[key])
+        self._init_fields(data)
+
 
+class Attachment(Model):
+    __slots__ = ('id', 'filename', 'size', 'url', 'proxy_url', 'height', 'width')
+    _fields = {
+        'id': None,
+        'filename': None,
+        'size': 0,
+        'url': None,
+        'proxy_url': None,
+        'height': None,
+        'width': None
+    }
+    _snowflakes = frozenset(('id',))
 
-class Emoji:
     def __init__(self, data):
-        for key in data:
-            setattr(self, key, data[key])
+        self._init_fields(data)
+
+
+class Emoji(Model):
+    __slots__ = ('id', 'name', 'roles', 'user', 'require_colons', 'managed', 'animated')
+    _fields = {
+        'id': None,
+        'name': None,
+        'require_colons': False,
+        'managed': False,
+        'animated': False
+    }
+    _snowflakes = frozenset(('id',))
+
+    def __init__(self, data, users=None):
+        self._init_fields(data)
+        self.roles = [snowflake(role_id) for role_id in data.get('roles', ())]
+        user = data.get('user')
+        self.user = make_user(user, users) if user is not None else None
 
 
 class Member:
-    def __init__(self, data):
-        self.user = User(data['user'])
+    __slots__ = ('user', 'nick', 'roles', 'joined_at', 'deaf', 'mute')
+
+    def __init__(self, data, users=None):
+        self.user = make_user(data['user'], users)
         self.nick = data.get('nick', self.user.username)
-        self.roles = data['roles']  # Array of snowflakes. Exact role data is stored in the guild object
+        self.roles = [snowflake(role_id) for role_id in data['roles']]  # Exact role data is stored in the guild object
         self.joined_at = data['joined_at']
         self.deaf = data['deaf']
         self.mute = data['mute']
 
-    def update(self, data):
+    def update(self, data, users=None):
         userData = data.get('user', None)
         if userData is not None:
-            self.user = User(userData)
+            self.user = make_user(userData, users)
         self.nick = data.get('nick', self.user.username)
-        self.roles = data.get('roles', self.roles)
+        if 'roles' in data:
+            self.roles = [snowflake(role_id) for role_id in data['roles']]
 
 
-class Guild:
-    def __init__(self, data):
-        self.id = data['id']
-        self.unavailable = data.get('unavailable', False)
-        if self.unavailable:
-            return
-        self.name = data['name']
-        self.icon = data['icon']
-        self.splash = data['splash']
-        self.owner = data.get('owner', False)
-        self.owner_id = data['owner_id']
-        self.permissions = data.get('permissions', 0)
-        self.region = data['region']
-        self.afk_channel_id = data['afk_channel_id']
-        self.afk_timeout = data['afk_timeout']
-        self.embed_enabled = data.get('embed_enabled', False)
-        self.embed_channel_id = data.get('embed_channel_id', None)
-        self.verification_level = data['verification_level']
-        self.default_message_notifications = data['default_message_notifications']
-        self.explicit_content_filter = data['explicit_content_filter']
-        self.roles = {}
-        for roleData in data['roles']:
-            role = Role(roleData)
-            self.roles[role.id] = role
-        self.emojis = {}
-        for emojiData in data.get('emojis', []):
-            emoji = Emoji(emojiData)
-            self.emojis[emoji.id] = emoji
-        self.features = data['features']
-        self.mfa_level = data['mfa_level']
-        self.application_id = data['application_id']
-        self.widget_enabled = data.get('widget_enabled', False)
-        self.widget_channel_id = data.get('widget_channel_id', None)
-        self.system_channel_id = data['system_channel_id']
-        self.joined_at = data.get('joined_at', None)
-        self.large = data.get('large', False)
-        self.member_count = data.get('member_count', 0)
-        # TODO parse partial voice states
-        self.members = {}
-        for memberData in data.get('members', []):
-            member = Member(memberData)
-            self.members[member.user.id] = member
-        self.channels = {}
-        for channelData in data.get('channels', []):
-            channel = Channel(channelData, self)
-            self.channels[channel.id] = channel
+def _compact(items):
+    """
+    Re-encode part of a payload until it is needed, encoded json is a fraction of the size of the decoded objects
+    :rtype: tuple
+    """
+    if not items:
+        return None
+    return len(items), json.dumps(items, separators=(',', ':')).encode()
+
+
+def _store(payload, name, items):
+    """Keep part of a payload compacted, nothing is kept for an empty part so ``Guild.hydrated`` holds"""
+    compacted = _compact(items)
+    if compacted is None:
+        payload.pop(name, None)
+    else:
+        payload[name] = compacted
+
+
+def _expand(compacted):
+    """
+    :return: The payload items stored by :func:`_compact`
+    :rtype: list
+    """
+    if compacted is None:
+        return []
+    return json.loads(compacted[1].decode())
+
+
+class _Encoded(bytes):
+    """Part of a snapshot that is still encoded json, :func:`encode_snapshot` copies it in as it is"""
+    __slots__ = ()
+
+
+def encode_snapshot(data):
+    """
+    Encode a snapshot taken by :meth:`Guild.snapshot` to a GUILD_CREATE payload, meant to run in an executor
+    :rtype: str
+    """
+    data = dict(data)
+    # only the ids of these are known, which is all the routing needs
+    uncached = [{'id': str(channel_id), 'type': ChannelType.GUILD_TEXT.value}
+                for channel_id in data.pop('uncached_channels')]
+    channels = data['channels']
+    if not isinstance(channels, _Encoded):
+        data['channels'] = channels + uncached
+    elif uncached:
+        uncached = json.dumps(uncached, separators=(',', ':')).encode()
+        # joins the two json lists without decoding either
+        data['channels'] = _Encoded(channels[:-1] + b',' + uncached[1:]) if channels != b'[]' else _Encoded(uncached)
+    plain = {}
+    encoded = []
+    for key, value in data.items():
+        if isinstance(value, _Encoded):
+            encoded.append(',"{}":{}'.format(key, value.decode()))
+        else:
+            plain[key] = value
+    return json.dumps(plain, separators=(',', ':'))[:-1] + ''.join(encoded) + '}'
+
+
+# what a channel keeps of a voice state, see Channel.add_voice_user
+_voice_state_keys = ('user_id', 'channel_id', 'deaf', 'mute', 'self_deaf', 'self_mute')
+
+
+class Guild(Model):
+    __slots__ = ('id', 'unavailable', 'name', 'icon', 'splash', 'owner', 'owner_id', 'permissions', 'region',
+                 'afk_channel_id', 'afk_timeout', 'embed_enabled', 'embed_channel_id', 'verification_level',
+                 'default_message_notifications', 'explicit_content_filter', 'features', 'mfa_level',
+                 'application_id', 'widget_enabled', 'widget_channel_id', 'system_channel_id', 'joined_at', 'large',
+                 'member_count', 'channel_ids', 'voice_states', 'uncached_channels', '_roles', '_emojis', '_members',
+                 '_channels', '_payload', '_voice_data', '_member_cache_size', '_message_cache', '_users', '_policy')
+    _fields = {
+        'unavailable': False,
+        'name': None,
+        'icon': None,
+        'splash': None,
+        'owner': False,
+        'owner_id': None,
+        'permissions': 0,
+        'region': None,
+        'afk_channel_id': None,
+        'afk_timeout': 0,
+        'embed_enabled': False,
+        'embed_channel_id': None,
+        'verification_level': 0,
+        'default_message_notifications': 0,
+        'explicit_content_filter': 0,
+        'features': (),
+        'mfa_level': 0,
+        'application_id': None,
+        'widget_enabled': False,
+        'widget_channel_id': None,
+        'system_channel_id': None,
+        'joined_at': None,
+        'large': False,
+        'member_count': 0
+    }
+    _snowflakes = frozenset(('owner_id', 'afk_channel_id', 'embed_channel_id', 'application_id', 'widget_channel_id',
+                             'system_channel_id'))
+    # kept compacted until first needed, or not kept at all
+    _handled_keys = frozenset(('roles', 'emojis', 'members', 'channels', 'presences'))
+
+    def __init__(self, data, *, member_cache_size=1000, preload_members=False, message_cache=None, users=None,
+                 policy=None):
+        """
+        Roles, emojis, members and channels are only built on first access, until then the guild keeps the parts
+        of the payload they are built from. The channel ids and voice states are extracted right away.
+
+        :param policy: Which categories are cached, everything when not given
+        :type policy: darkPy.cache.CachePolicy
+        :param users: The cache users are interned in
+        :type users: darkPy.user.UserCache
+        :param message_cache: The cache the messages of the channels are kept in
+        :type message_cache: darkPy.cache.MessageCache
+        :param member_cache_size: The maximum amount of members kept for this guild, None for no limit
+        :type member_cache_size: int
+        :param preload_members: Also cache the members sent along in the guild payload
+        :type preload_members: bool
+        """
+        self.id = snowflake(data['id'])
+        self._message_cache = message_cache
+        self._users = users
+        self._member_cache_size = member_cache_size
+        self._policy = policy = CachePolicy() if policy is None else policy
+        self._init_fields(data)
+        self._roles = None
+        self._emojis = None
+        self._members = None
+        self._channels = None
+        # ids of the channels that are (or will be) built, for routing events without building them
+        self.channel_ids = set()
+        # ids of the channels the policy keeps out of the cache, still needed to route events to this guild
+        self.uncached_channels = set()
+        # user id -> voice channel id, the channels keep the users connected to them
+        self.voice_states = {}
+        # voice state payloads waiting for the channels to be built
+        self._voice_data = {}
+        # only keep what the policy will ever build, the rest of the payload can be freed
+        payload = {}
+        if not self.unavailable:
+            if policy.roles:
+                _store(payload, 'roles', data.get('roles'))
+            if policy.emojis:
+                _store(payload, 'emojis', data.get('emojis'))
+            if preload_members and policy.members:
+                _store(payload, 'members', data.get('members'))
+            channels = []
+            for channelData in data.get('channels', []):
+                if self._is_cached_channel(channelData):
+                    self.channel_ids.add(snowflake(channelData['id']))
+                    channels.append(channelData)
+                else:
+                    self.uncached_channels.add(snowflake(channelData['id']))
+            _store(payload, 'channels', channels)
+            for voiceData in data.get('voice_states', []):
+                self.update_voice_state(voiceData)
+        self._payload = payload
         # TODO parse presences data
 
+    @property
+    def hydrated(self):
+        """Whether every collection of this guild has been built from its payload"""
+        return not self._payload
+
+    @property
+    def roles(self):
+        if self._roles is None:
+            if not self._policy.roles:
+                self._roles = DisabledCache('roles')
+            else:
+                self._roles = {}
+                for roleData in _expand(self._payload.pop('roles', None)):
+                    role = Role(roleData)
+                    self._roles[role.id] = role
+        return self._roles
+
+    @property
+    def emojis(self):
+        if self._emojis is None:
+            if not self._policy.emojis:
+                self._emojis = DisabledCache('emojis')
+            else:
+                self._emojis = {}
+                for emojiData in _expand(self._payload.pop('emojis', None)):
+                    emoji = Emoji(emojiData, self._users)
+                    self._emojis[emoji.id] = emoji
+        return self._emojis
+
+    @property
+    def members(self):
+        if self._members is None:
+            if not self._policy.members:
+                self._members = DisabledCache('members')
+            else:
+                # Members are fetched on demand, see ConnectionState.fetch_member
+                self._members = LRUCache(self._member_cache_size)
+                for memberData in _expand(self._payload.pop('members', None)):
+                    member = Member(memberData, self._users)
+                    self._members[member.user.id] = member
+        return self._members
+
+    @property
+    def cached_member_count(self):
+        """The amount of cached members, without building the member cache"""
+        if self._members is None:
+            # not built yet, so these are only the preloaded members of the payload
+            return (self._payload.get('members') or (0, b''))[0]
+        return len(self._members)
+
+    @property
+    def channels(self):
+        if self._channels is None:
+            self._channels = {}
+            for channelData in _expand(self._payload.pop('channels', None)):
+                channel = Channel(channelData, self, self._message_cache, self._users)
+                self._channels[channel.id] = channel
+            for voiceData in self._voice_data.values():
+                self._channels[snowflake(voiceData['channel_id'])].add_voice_user(voiceData)
+            self._voice_data = {}
+        return self._channels
+
+    def snapshot(self):
+        """
+        What is needed to restore this guild. Collections that were never built are taken over in their compacted
+        form, so taking a snapshot does not decode them. :func:`encode_snapshot` turns it into a GUILD_CREATE
+        payload, off the loop.
+        :rtype: dict
+        """
+        data = self.to_dict()
+        data['id'] = str(self.id)
+        if self._policy.roles:
+            data['roles'] = [role.to_dict() for role in self._roles.values()] if self._roles is not None \
+                else self._snapshot_payload('roles')
+        if self._policy.emojis:
+            data['emojis'] = [emoji.to_dict() for emoji in self._emojis.values()] if self._emojis is not None \
+                else self._snapshot_payload('emojis')
+        if self._channels is not None:
+            data['channels'] = [channel.to_dict() for channel in self._channels.values()]
+        else:
+            data['channels'] = self._snapshot_payload('channels')
+        data['uncached_channels'] = list(self.uncached_channels)
+        voice_states = []
+        for user_id, channel_id in self.voice_states.items():
+            if self._channels is not None:
+                voice_state = dict(self._channels[channel_id].connected_users.get(user_id, {}))
+            else:
+                voice_state = dict(self._voice_data[user_id])
+            voice_state['user_id'] = str(user_id)
+            voice_state['channel_id'] = str(channel_id)
+            voice_states.append(voice_state)
+        data['voice_states'] = voice_states
+        return data
+
+    def _snapshot_payload(self, name):
+        compacted = self._payload.get(name)
+        return _Encoded(compacted[1] if compacted is not None else b'[]')
+
+    def update(self, data):
+        """
+        Apply a GUILD_UPDATE payload in place. Only the fields present in it change, the channels, members and
+        voice states are not part of it and are left alone.
+        :param data: The guild payload
+        :type data: dict
+        """
+        self._update_fields(data)
+        if 'roles' in data:
+            self.set_roles(data['roles'])
+        if 'emojis' in data:
+            self.set_emojis(data['emojis'])
+
+    def set_roles(self, roles):
+        if not self._policy.roles:
+            return
+        if self._roles is None:
+            # never built, so replacing what it would be built from is enough
+            _store(self._payload, 'roles', roles)
+            return
+        # roles that still exist are updated, so references to them stay valid
+        newRoles = {}
+        for roleData in roles:
+            role = self._roles.get(snowflake(roleData['id']))
+            if role is None:
+                role = Role(roleData)
+            else:
+                role._update_fields(roleData)
+            newRoles[role.id] = role
+        self._roles = newRoles
+
     def set_emojis(self, emojis):
-        self.emojis = {}
+        if not self._policy.emojis:
+            return
+        if self._emojis is None:
+            _store(self._payload, 'emojis', emojis)
+            return
+        self._emojis = {}
         for emojiData in emojis:
-            emoji = Emoji(emojiData)
-            self.emojis[emoji.id] = emoji
+            emoji = Emoji(emojiData, self._users)
+            self._emojis[emoji.id] = emoji
 
     def add_member(self, user):
-        member = Member(user)
+        member = Member(user, self._users)
         self.members[member.user.id] = member
+        return member
+
+    def get_member(self, user_id):
+        """
+        :return: The cached member or None, use ConnectionState.fetch_member to load it when needed
+        :rtype: Member
+        """
+        return self.members.get(user_id)
 
     def remove_member(self, user_id):
-        self.members[user_id] = None
+        self.members.pop(user_id)
 
     def update_member(self, data):
-        member = self.members.get(data['user']['id'])
-        member.update(data)
+        member = self.members.peek(snowflake(data['user']['id']))
+        if member is not None:
+            member.update(data, self._users)
+
+    def _is_cached_channel(self, data):
+        return self._policy.channels or data.get('type') == ChannelType.GUILD_VOICE.value
 
     def add_channel(self, data):
-        channel = Channel(data, self)
+        """
+        :return: The new channel, or None when the cache policy does not keep this kind of channel
+        :rtype: Channel
+        """
+        if not self._is_cached_channel(data):
+            self.uncached_channels.add(snowflake(data['id']))
+            return None
+        channel = Channel(data, self, self._message_cache, self._users)
         self.channels[channel.id] = channel
+        self.channel_ids.add(channel.id)
+        return channel
 
     def update_channel(self, data):
-        oldChannel = self.channels.get(data['id'])
-        if oldChannel:
-            messages = oldChannel.messages
-            channel = Channel(data)
-            for key in messages:
-                channel.add_message(messages[key])
-            self.channels[channel.id] = channel
+        """
+        Apply a CHANNEL_UPDATE payload to the existing channel in place, its messages and voice users stay with it
+        :return: The updated channel, or None when the cache policy does not keep this kind of channel
+        :rtype: Channel
+        """
+        channel_id = snowflake(data['id'])
+        if channel_id not in self.channel_ids:
+            # unknown, or a kind of channel that was not cached until now
+            self.uncached_channels.discard(channel_id)
+            return self.add_channel(data)
+        if 'type' in data and not self._is_cached_channel(data):
+            # changed into a kind of channel the policy does not keep
+            self.remove_channel(channel_id)
+            self.uncached_channels.add(channel_id)
+            return None
+        channel = self.channels[channel_id]
+        connected = channel.connected_users
+        channel.update(data)
+        if connected and channel.connected_users is None:
+            # no longer a voice channel, so nobody is connected to it anymore
+            for user_id in connected:
+                self.voice_states.pop(user_id, None)
+        return channel
+
+    def clear_messages(self):
+        """Drop the cached messages of every channel in this guild"""
+        # channels that were never built have no messages either
+        for channel in (self._channels or {}).values():
+            channel.clear_messages()
 
     def remove_channel(self, channel_id):
-        if self.channels.get(channel_id, None):
-            self.channels[channel_id] = None
+        self.uncached_channels.discard(channel_id)
+        self.channel_ids.discard(channel_id)
+        channel = self.channels.pop(channel_id, None)
+        if channel is not None:
+            channel.clear_messages()
+        for user_id in getattr(channel, 'connected_users', None) or ():
+            self.voice_states.pop(user_id, None)
+
+    def update_voice_state(self, data):
+        """
+        Move a user to the channel in a voice state, or out of voice when it has no channel
+        :param data: A voice state payload
+        :type data: dict
+        """
+        self.remove_voice_user(data)
+        channel_id = snowflake(data.get('channel_id'))
+        if channel_id not in self.channel_ids:
+            return
+        user_id = snowflake(data['user_id'])
+        self.voice_states[user_id] = channel_id
+        if self._channels is None:
+            self._voice_data[user_id] = {key: data[key] for key in _voice_state_keys if key in data}
+        else:
+            self._channels[channel_id].add_voice_user(data)
 
     def remove_voice_user(self, data):
-        for key, channel in self.channels.items():
-            channel.remove_voice_user(data['user_id'])
+        user_id = snowflake(data['user_id'])
+        channel_id = self.voice_states.pop(user_id, None)
+        if self._channels is None:
+            self._voice_data.pop(user_id, None)
+            return
+        channel = self._channels.get(channel_id)
+        if channel is not None:
+            channel.remove_voice_user(user_id)
 
     def get_voice_channel_for_user(self, user_id):
-        for key, channel in self.channels.items():
-            if channel.contains_user(user_id):
-                return channel
+        channel_id = self.voice_states.get(user_id)
+        if channel_id is None:
+            return None
+        return self.channels.get(channel_id)
@@ -1,5 +1,11 @@
+import asyncio
 import json
 import logging
+import logging.handlers
+import queue
+import socket
+import threading
+import time
 import urllib
 
 import requests
@@ -19,15 +25,194 @@ formattter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(messa
 ch.setFormatter(formattter)
 logger.addHandler(ch)
 
+# Set while production logging is active
+_listener = None
+_queue_handler = None
+_sampling = False
 
-def get_gateway():
-    r = requests.get(api_ref +"/gateway")
-    return r.json()['url'] + "?" + urllib.parse.urlencode(api_options)
+# A single pooled HTTP session so repeated REST calls reuse the same connection
+_session = requests.Session()
+
+# Cached gateway information, shared across reconnects
+gateway_cache_ttl = 60 * 60
+_gateway_cache = None
+_gateway_lock = threading.Lock()
+
+# host -> (address, resolved at), voice endpoints are resolved again on every join otherwise
+host_cache_ttl = 5 * 60
+_host_cache = {}
+
+
+def _fetch_gateway(token=None):
+    if token:
+        r = _session.get(api_ref + "/gateway/bot", headers={'Authorization': 'Bot ' + token}, timeout=10)
+        if r.status_code == 401:
+            # Fall back to the unauthenticated endpoint, it still gives us an url
+            r = _session.get(api_ref + "/gateway", timeout=10)
+    else:
+        r = _session.get(api_ref + "/gateway", timeout=10)
+    r.raise_for_status()
+    data = r.json()
+    return {
+        'url': data['url'] + "?" + urllib.parse.urlencode(api_options),
+        'shards': data.get('shards', 1),
+        'fetched_at': time.time()
+    }
+
+
+def get_gateway(token=None, *, force=False):
+    """
+    Retrieve the gateway url, using the cached value when it is still fresh.
+    This blocks, use :func:`get_gateway_async` from the event loop.
+    :param token: The bot token, used to also retrieve the recommended shard count
+    :type token: str
+    :param force: Ignore the cached value
+    :type force: bool
+    :return: The gateway url with the api options appended
+    :rtype: str
+    """
+    global _gateway_cache
+    with _gateway_lock:
+        cache = _gateway_cache
+        if force or cache is None or cache['fetched_at'] + gateway_cache_ttl < time.time():
+            cache = _fetch_gateway(token)
+            _gateway_cache = cache
+        return cache['url']
+
+
+@asyncio.coroutine
+def get_gateway_async(loop, token=None, *, force=False):
+    """
+    Retrieve the gateway url without blocking the event loop.
+    A fresh cached value is returned directly, otherwise the request runs in the default executor.
+    """
+    cache = _gateway_cache
+    if not force and cache is not None and cache['fetched_at'] + gateway_cache_ttl >= time.time():
+        return cache['url']
+    return (yield from loop.run_in_executor(None, lambda: get_gateway(token, force=force)))
+
+
+def set_gateway(url, shards=None):
+    """Seed the gateway cache, for example with the url a stored session was connected to"""
+    global _gateway_cache
+    with _gateway_lock:
+        _gateway_cache = {'url': url, 'shards': shards, 'fetched_at': time.time()}
+
+
+def get_gateway_shards():
+    """
+    :return: The recommended shard count from the last gateway lookup, or None if unknown
+    :rtype: int
+    """
+    cache = _gateway_cache
+    return cache['shards'] if cache is not None else None
+
+
+def invalidate_gateway():
+    """Drop the cached gateway so the next lookup goes to the API again"""
+    global _gateway_cache
+    with _gateway_lock:
+        _gateway_cache = None
+
+
+@asyncio.coroutine
+def resolve_host(loop, host, *, force=False):
+    """
+    Resolve a host to an IPv4 address without blocking the event loop, cached per host for ``host_cache_ttl``
+    :param host: The host name, for example a voice endpoint
+    :type host: str
+    :param force: Ignore the cached address
+    :type force: bool
+    :return: The IP address
+    :rtype: str
+    """
+    cached = _host_cache.get(host)
+    if not force and cached is not None and cached[1] + host_cache_ttl >= time.monotonic():
+        return cached[0]
+    infos = yield from loop.getaddrinfo(host, None, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+    address = infos[0][4][0]
+    _host_cache[host] = (address, time.monotonic())
+    return address
+
+
+def invalidate_host(host):
+    """Drop the cached address of a host, for when it stopped answering"""
+    _host_cache.pop(host, None)
 
 
 def setup_logger():
     return logger
 
 
+def enable_production_logging(level=logging.INFO, handler=None):
+    """
+    Switch the darkPy logger to a low overhead mode.
+    Records are put on a queue and written by a background thread, so neither the event loop nor
+    the audio threads ever block on I/O. High frequency logs go through their :class:`LogSampler`.
+    :param level: The minimum level that is logged
+    :type level: int
+    :param handler: The handler that does the actual writing, defaults to the stream handler
+    :type handler: logging.Handler
+    """
+    global _listener, _queue_handler, _sampling
+    if _listener is not None:
+        return
+    target = ch if handler is None else handler
+    target.setLevel(level)
+
+    log_queue = queue.Queue(-1)
+    _queue_handler = logging.handlers.QueueHandler(log_queue)
+    logger.removeHandler(ch)
+    logger.addHandler(_queue_handler)
+    logger.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, target, respect_handler_level=True)
+    _listener.start()
+    _sampling = True
+
+
+def disable_production_logging():
+    """Restore the default synchronous debug logging"""
+    global _listener, _queue_handler, _sampling
+    if _listener is None:
+        return
+    _listener.stop()
+    logger.removeHandler(_queue_handler)
+    ch.setLevel(_level)
+    logger.addHandler(ch)
+    logger.setLevel(_level)
+    _listener = None
+    _queue_handler = None
+    _sampling = False
+
+
+class LogSampler:
+    """
+    Rate limit for per-event and per-packet logs.
+    Calling the sampler tells whether a record may be logged. Limits only apply in production logging mode,
+    at most ``rate`` records are let through per ``period`` seconds.
+    """
+
+    def __init__(self, rate, period=1.0):
+        self.rate = rate
+        self.period = period
+        self.suppressed = 0
+        self._window_start = 0.0
+        self._count = 0
+
+    def __call__(self):
+        if not _sampling:
+            return True
+        now = time.monotonic()
+        if now - self._window_start >= self.period:
+            self._window_start = now
+            self._count = 0
+        self._count += 1
+        if self._count > self.rate:
+            self.suppressed += 1
+            return False
+        return True
+
+
 def to_json(data):
     return json.dumps(data, separators=(',', ':'), ensure_ascii=True)
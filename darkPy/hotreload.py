@@ -0,0 +1,103 @@
+import asyncio
+import functools
+import importlib
+import os
+import sys
+
+from darkPy import helpers
+
+log = helpers.setup_logger()
+
+
+class CommandReloader:
+    """
+    Keeps the command handlers of a client up to date with the source of the module they live in.
+
+    The package directory of the module is polled for changed ``.py`` files from an executor, so the event loop
+    never touches the filesystem. Only when something changed are the modules reloaded, after which the handler
+    table of the client is swapped in one assignment. Dispatching a command stays a plain dict lookup.
+    """
+
+    def __init__(self, client, module, commands, *, interval=1.0):
+        """
+        :param client: The client the handlers are registered on, it is passed to every handler
+        :type client: darkPy.client.Client
+        :param module: The module with the handlers
+        :type module: module
+        :param commands: Command name -> name of the handler function in ``module``
+        :type commands: dict
+        :param interval: Seconds between checks for changed files
+        :type interval: float
+        """
+        self.client = client
+        self.module = module
+        self.commands = commands
+        self.interval = interval
+        self.directory = os.path.dirname(os.path.abspath(module.__file__))
+        self.reloads = 0
+        self._mtimes = self._scan()
+        self._task = None
+
+    def install(self):
+        """Register the handlers of the currently loaded module on the client"""
+        handlers = {}
+        for name, attribute in self.commands.items():
+            handlers[name] = functools.partial(getattr(self.module, attribute), client=self.client)
+        table = dict(self.client.command_listeners)
+        table.update(handlers)
+        # a single assignment, a command is dispatched to either the old or the new table, never a mix
+        self.client.command_listeners = table
+
+    def start(self):
+        self.install()
+        self._task = self.client.loop.create_task(self.watch())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    @asyncio.coroutine
+    def watch(self):
+        loop = self.client.loop
+        while True:
+            yield from asyncio.sleep(self.interval, loop=loop)
+            mtimes = yield from loop.run_in_executor(None, self._scan)
+            changed = [path for path, mtime in mtimes.items() if self._mtimes.get(path) != mtime]
+            self._mtimes = mtimes
+            if changed:
+                self.reload(changed)
+
+    def reload(self, changed):
+        """
+        Reload the modules of the changed files and install the new handlers.
+        When a module fails to load the handlers that are installed stay in place.
+        :param changed: Paths of the changed source files
+        :type changed: list
+        """
+        modules = [module for module in list(sys.modules.values())
+                   if getattr(module, '__file__', None) and os.path.abspath(module.__file__) in changed
+                   and module is not self.module]
+        try:
+            for module in modules:
+                importlib.reload(module)
+            # last, so it picks up the reloaded modules it imports
+            importlib.reload(self.module)
+        except Exception:
+            log.exception('Reloading the command handlers failed, keeping the loaded ones')
+            return
+        self.install()
+        self.reloads += 1
+        log.info('Reloaded command handlers after changes to %s', ', '.join(os.path.basename(path) for path in changed))
+
+    def _scan(self):
+        mtimes = {}
+        for name in os.listdir(self.directory):
+            if name.endswith('.py'):
+                path = os.path.join(self.directory, name)
+                try:
+                    mtimes[path] = os.stat(path).st_mtime_ns
+                except OSError:
+                    # removed while scanning, it counts as changed on the next scan
+                    pass
+        return mtimes
@@ -0,0 +1,131 @@
+import audioop
+import math
+import shutil
+import subprocess
+import wave
+
+from darkPy import helpers
+
+log = helpers.setup_logger()
+
+# what every clip is normalized to, in dB relative to full scale
+target_loudness = -20.0
+# a 10ms block quieter than this counts as silence when trimming
+silence_threshold = -50.0
+# normalizing never pushes the peak above this, as a fraction of full scale
+peak_limit = 0.98
+
+
+class Analysis:
+    __slots__ = ('loudness', 'peak', 'start', 'end', 'duration')
+
+    def __init__(self, loudness, peak, start, end, duration):
+        # dBFS, None for a silent clip
+        self.loudness = loudness
+        # fraction of full scale
+        self.peak = peak
+        # seconds of the clip left after trimming silence at both ends
+        self.start = start
+        self.end = end
+        self.duration = duration
+
+    @property
+    def gain(self):
+        """The linear gain that brings the clip to ``target_loudness``, limited so it does not clip"""
+        if self.loudness is None or self.peak <= 0:
+            return 1.0
+        gain = 10 ** ((target_loudness - self.loudness) / 20)
+        return min(gain, peak_limit / self.peak)
+
+
+def _db(power):
+    return 10 * math.log10(power) if power > 0 else None
+
+
+def analyse(pcm, width, rate, channels):
+    """
+    Measure the loudness and the silence at the ends of a clip.
+
+    The loudness is the gated mean power of 400ms blocks overlapping by 75%, with the absolute (-70) and relative
+    (-10 dB) gates of ITU-R BS.1770, without its K-weighting filter.
+
+    :param pcm: The samples, interleaved
+    :type pcm: bytes
+    :param width: Bytes per sample
+    :type width: int
+    :rtype: Analysis
+    """
+    if width == 1:
+        # 8 bit wav is unsigned, audioop expects signed samples
+        pcm = audioop.bias(pcm, 1, -128)
+    if channels == 2:
+        pcm = audioop.tomono(pcm, width, 0.5, 0.5)
+    full_scale = float(2 ** (8 * width - 1))
+    frame = width
+    duration = len(pcm) / (frame * rate)
+
+    # trimming works on 10ms blocks
+    step = max(frame, rate // 100 * frame)
+    silence = full_scale * 10 ** (silence_threshold / 20)
+    blocks = [audioop.rms(pcm[i:i + step], width) for i in range(0, len(pcm), step)]
+    loud = [index for index, rms in enumerate(blocks) if rms > silence]
+    if not loud:
+        return Analysis(None, 0.0, 0.0, duration, duration)
+    start = loud[0] * step / (frame * rate)
+    end = min(duration, (loud[-1] + 1) * step / (frame * rate))
+
+    block = rate * 4 // 10 * frame
+    hop = block // 4
+    powers = []
+    for i in range(0, max(1, len(pcm) - block + 1), hop):
+        rms = audioop.rms(pcm[i:i + block], width) / full_scale
+        powers.append(rms * rms)
+    gated = [power for power in powers if power > 1e-7]  # -70 dB
+    loudness = None
+    if gated:
+        relative = _db(sum(gated) / len(gated)) - 10
+        gated = [power for power in gated if _db(power) > relative]
+        loudness = _db(sum(gated) / len(gated))
+    peak = audioop.max(pcm, width) / full_scale
+    return Analysis(loudness, peak, start, end, duration)
+
+
+def decode(path):
+    """
+    Read the samples of a clip, wav directly and other formats through ffmpeg when it is installed
+
+    :return: (pcm, width, rate, channels), or None when the clip can not be decoded
+    :rtype: tuple
+    """
+    if path.lower().endswith('.wav'):
+        try:
+            with wave.open(path, 'rb') as clip:
+                if clip.getnchannels() <= 2:
+                    return clip.readframes(clip.getnframes()), clip.getsampwidth(), clip.getframerate(), \
+                           clip.getnchannels()
+        except (wave.Error, EOFError):
+            # not PCM, ffmpeg may still read it
+            pass
+    if shutil.which('ffmpeg') is None:
+        return None
+    try:
+        pcm = subprocess.run(['ffmpeg', '-loglevel', 'error', '-i', path, '-f', 's16le', '-ac', '2', '-ar', '48000',
+                              'pipe:1'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+                             timeout=60).stdout
+    except (subprocess.SubprocessError, OSError) as e:
+        log.warning('Could not decode %s: %r', path, e)
+        return None
+    return pcm, 2, 48000, 2
+
+
+def analyse_file(path):
+    """
+    Decode and analyse a clip, this takes a while for long clips and is meant to run once per clip
+
+    :return: The analysis, or None when the clip can not be decoded
+    :rtype: Analysis
+    """
+    decoded = decode(path)
+    if decoded is None:
+        return None
+    return analyse(*decoded)
@@ -0,0 +1,95 @@
+import asyncio
+import itertools
+
+from darkPy import helpers
+
+log = helpers.setup_logger()
+
+
+class MemberRequester:
+    """
+    Fetches guild members on demand through REQUEST_MEMBERS.
+
+    Lookups for the same guild arriving within ``batch_delay`` seconds are sent as one request,
+    and concurrent lookups for the same member share a single pending result.
+    """
+
+    def __init__(self, state, *, loop, batch_delay=0.05, batch_size=100, timeout=10.0):
+        self.state = state
+        self.loop = loop
+        self.batch_delay = batch_delay
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self._inflight = {}
+        self._batches = {}
+        self._requests = {}
+        self._nonces = itertools.count()
+
+    @asyncio.coroutine
+    def fetch(self, guild_id, user_id):
+        """
+        :return: The member, or None if the user is not in the guild or the request timed out
+        :rtype: darkPy.guild.Member
+        """
+        key = (guild_id, user_id)
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.Future(loop=self.loop)
+            self._inflight[key] = future
+            batch = self._batches.get(guild_id)
+            if batch is None:
+                batch = self._batches[guild_id] = []
+                self.loop.call_later(self.batch_delay, self._flush, guild_id)
+            batch.append(user_id)
+            if len(batch) >= self.batch_size:
+                self._flush(guild_id)
+        return (yield from asyncio.shield(future, loop=self.loop))
+
+    def _flush(self, guild_id):
+        user_ids = self._batches.pop(guild_id, None)
+        if not user_ids:
+            return
+        nonce = str(next(self._nonces))
+        self._requests[nonce] = (guild_id, set(user_ids))
+        self.loop.call_later(self.timeout, self._expire, nonce)
+        self.loop.create_task(self._send(guild_id, user_ids, nonce))
+
+    @asyncio.coroutine
+    def _send(self, guild_id, user_ids, nonce):
+        try:
+            yield from self.state.client.ws.request_members(guild_id, user_ids=user_ids, nonce=nonce)
+        except Exception as e:
+            log.warning('Could not request members for guild %s: %r', guild_id, e)
+            self._expire(nonce)
+
+    def _resolve(self, guild_id, user_id, member):
+        future = self._inflight.pop((guild_id, user_id), None)
+        if future is not None and not future.done():
+            future.set_result(member)
+
+    def _expire(self, nonce):
+        request = self._requests.pop(nonce, None)
+        if request is None:
+            return
+        guild_id, user_ids = request
+        for user_id in user_ids:
+            self._resolve(guild_id, user_id, None)
+
+    def chunk_received(self, guild_id, nonce, members, not_found, last):
+        """
+        Hand out the members of a GUILD_MEMBERS_CHUNK to everyone waiting for them
+        :param members: The parsed members keyed by user id
+        :type members: dict
+        """
+        request = self._requests.get(nonce)
+        for user_id, member in members.items():
+            self._resolve(guild_id, user_id, member)
+            if request is not None:
+                request[1].discard(user_id)
+        for user_id in not_found:
+            self._resolve(guild_id, user_id, None)
+            if request is not None:
+                request[1].discard(user_id)
+        if last:
+            # Anything that was not in any chunk is not in the guild
+            self._expire(nonce)
@@ -1,52 +1,56 @@
-from darkPy.guild import Attachment, Role
-from darkPy.user import User
+from darkPy.guild import Attachment
+from darkPy.model import Model, snowflake
+from darkPy.user import make_user
 
 
-class Message:
-    def __init__(self, data):
-        for key in data:
-            if key == 'author':
-                setattr(self, key, User(data[key]))
-            elif key == 'mentions':
-                mentions = []
-                for userData in data[key]:
-                    user = User(userData)
-                    mentions.append(user)
-                setattr(self, key, mentions)
-            elif key == 'mention_roles':
-                roles = []
-                for roleData in data[key]:
-                    role = Role(roleData)
-                    roles.append(role)
-                setattr(self, key, roles)
-            elif key == 'attachments':
-                attachments = []
-                for attachmentData in data[key]:
-                    attachments.append(Attachment(attachmentData))
-                setattr(self, key, attachments)
-            else:
-                setattr(self, key, data[key])
+class Message(Model):
+    __slots__ = ('id', 'channel_id', 'guild_id', 'author', 'member', 'content', 'timestamp', 'edited_timestamp',
+                 'tts', 'mention_everyone', 'mentions', 'mention_roles', 'attachments', 'embeds', 'reactions',
+                 'nonce', 'pinned', 'webhook_id', 'type', 'activity', 'application')
+    _fields = {
+        'id': None,
+        'channel_id': None,
+        'guild_id': None,
+        'member': None,
+        'content': "",
+        'timestamp': None,
+        'edited_timestamp': None,
+        'tts': False,
+        'mention_everyone': False,
+        'embeds': (),
+        'reactions': (),
+        'nonce': None,
+        'pinned': False,
+        'webhook_id': None,
+        'type': 0,
+        'activity': None,
+        'application': None
+    }
+    _snowflakes = frozenset(('id', 'channel_id', 'guild_id', 'webhook_id'))
 
-    def update(self, data):
-        for key in data:
-            if key == 'author':
-                setattr(self, key, User(data[key]))
-            elif key == 'mentions':
-                mentions = []
-                for userData in data[key]:
-                    user = User(userData)
-                    mentions.append(user)
-                setattr(self, key, mentions)
-            elif key == 'mention_roles':
-                roles = []
-                for roleData in data[key]:
-                    role = Role(roleData)
-                    roles.append(role)
-                setattr(self, key, roles)
-            elif key == 'attachments':
-                attachments = []
-                for attachmentData in data[key]:
-                    attachments.append(Attachment(attachmentData))
-                setattr(self, key, attachments)
-            else:
-                setattr(self, key, data[key])
+    def __init__(self, data, users=None):
+        """
+        :param users: The cache the author and mentioned users are interned in
+        :type users: darkPy.user.UserCache
+        """
+        self.author = None
+        self.mentions = []
+        self.mention_roles = []
+        self.attachments = []
+        self._init_fields(data)
+        self._update_related(data, users)
+
+    def update(self, data, users=None):
+        self._update_fields(data)
+        self._update_related(data, users)
+
+    def _update_related(self, data, users):
+        if 'author' in data:
+            self.author = make_user(data['author'], users)
+        if 'mentions' in data:
+            self.mentions = [make_user(userData, users) for userData in data['mentions']]
+        if 'mention_roles' in data:
+            # these are role ids, the roles themselves are stored in the guild
+            self.mention_roles = [snowflake(role_id) for role_id in data['mention_roles']]
+        if 'attachments' in data:
+            self.attachments = [Attachment(attachmentData) for attachmentData in data['attachments']]
@@ -0,0 +1,255 @@
+import asyncio
+import bisect
+import threading
+import weakref
+
+from darkPy import helpers
+
+log = helpers.setup_logger()
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    A monotonically increasing value, optionally split by labels.
+    Increments are a single dict update so they are cheap enough for the dispatch path.
+    """
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, labels=()):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, labels=()):
+        return self._values.get(labels, 0)
+
+    def collect(self):
+        return dict(self._values)
+
+    def render(self):
+        for labels, value in list(self._values.items()):
+            yield '{}{} {}'.format(self.name, _format_labels(self.labelnames, labels), _format_value(value))
+
+
+class Gauge(Counter):
+    """A value that can go up and down, or is computed when collected"""
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._functions = {}
+
+    def set(self, value, labels=()):
+        self._values[labels] = value
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+    def set_function(self, func, labels=(), owner=None):
+        """
+        Compute the value by calling ``func`` at collection time instead of on every change
+        :type func: callable
+        :param owner: Passed to ``func`` and only weakly referenced, the series is dropped once it is garbage
+                      collected. The gauges live as long as the process, a callback closing over its object would
+                      keep it alive.
+        """
+        self._functions[labels] = (func, weakref.ref(owner) if owner is not None else None)
+
+    def collect(self):
+        values = dict(self._values)
+        for labels, entry in list(self._functions.items()):
+            func, owner = entry
+            args = ()
+            if owner is not None:
+                obj = owner()
+                if obj is None:
+                    if self._functions.get(labels) is entry:
+                        del self._functions[labels]
+                    continue
+                args = (obj,)
+            try:
+                values[labels] = func(*args)
+            except Exception as e:
+                log.warning('Could not collect gauge %s: %r', self.name, e)
+        return values
+
+    def render(self):
+        for labels, value in self.collect().items():
+            yield '{}{} {}'.format(self.name, _format_labels(self.labelnames, labels), _format_value(value))
+
+
+class Histogram:
+    """Counts observations into buckets, safe to observe from other threads"""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    def collect(self):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+            count = self._count
+        cumulative = {}
+        running = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            running += bucket_count
+            cumulative[bound] = running
+        return {'buckets': cumulative, 'sum': total, 'count': count}
+
+    def render(self):
+        data = self.collect()
+        for bound, value in data['buckets'].items():
+            yield '{}_bucket{{le="{}"}} {}'.format(self.name, _format_value(bound), value)
+        yield '{}_sum {}'.format(self.name, _format_value(data['sum']))
+        yield '{}_count {}'.format(self.name, data['count'])
+
+
+class Registry:
+    """Holds every metric so they can be collected together"""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, buckets))
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def collect(self):
+        """
+        :return: A snapshot of all metric values, keyed by metric name
+        :rtype: dict
+        """
+        return {name: metric.collect() for name, metric in self._metrics.items()}
+
+    def render(self):
+        """
+        :return: All metrics in the Prometheus text exposition format
+        :rtype: str
+        """
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+gateway_events = registry.counter('darkpy_gateway_events_total', 'Gateway DISPATCH events received', ('event',))
+heartbeat_rtt = registry.histogram('darkpy_heartbeat_rtt_seconds', 'Time between sending a heartbeat and its ACK')
+loop_lag = registry.gauge('darkpy_event_loop_lag_seconds', 'How late the last event loop lag probe woke up')
+loop_lag_histogram = registry.histogram('darkpy_event_loop_lag_distribution_seconds', 'Event loop lag probe delays')
+reconnects = registry.counter('darkpy_reconnects_total', 'Gateway and voice connections established', ('kind',))
+resumes = registry.counter('darkpy_resumes_total', 'RESUME attempts by outcome', ('outcome',))
+cache_size = registry.gauge('darkpy_cache_size', 'Amount of objects in the ConnectionState caches', ('cache',))
+message_cache = registry.counter('darkpy_message_cache_total', 'Message cache lookups and evictions', ('result',))
+
+
+@asyncio.coroutine
+def monitor_loop_lag(loop, interval=1.0):
+    """Periodically measure how much later than requested the event loop wakes us up"""
+    while True:
+        started = loop.time()
+        yield from asyncio.sleep(interval, loop=loop)
+        lag = max(0.0, loop.time() - started - interval)
+        loop_lag.set(lag)
+        loop_lag_histogram.observe(lag)
+
+
+class MetricsServer:
+    """A tiny HTTP server on the event loop that serves the registry in the Prometheus text format"""
+
+    def __init__(self, registry=registry, *, host='127.0.0.1', port=9100, loop=None):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.loop = asyncio.get_event_loop() if loop is None else loop
+        self._server = None
+
+    @asyncio.coroutine
+    def start(self):
+        self._server = yield from asyncio.start_server(self._handle, self.host, self.port, loop=self.loop)
+        log.info('Serving metrics on http://%s:%s/metrics', self.host, self.port)
+
+    @asyncio.coroutine
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+            yield from self._server.wait_closed()
+            self._server = None
+
+    @asyncio.coroutine
+    def _handle(self, reader, writer):
+        try:
+            request = yield from reader.readline()
+            # drain the headers, we do not need them
+            while True:
+                line = yield from reader.readline()
+                if not line or line in (b'\r\n', b'\n'):
+                    break
+            parts = request.decode('latin-1').split(' ')
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] in ('/', '/metrics'):
+                body = self.registry.render().encode('utf-8')
+                status = '200 OK'
+            else:
+                body = b'Not Found\n'
+                status = '404 Not Found'
+            writer.write('HTTP/1.0 {}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {}\r\n\r\n'
+                         .format(status, len(body)).encode('latin-1'))
+            writer.write(body)
+            yield from writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,76 @@
+# Keep payload fields a model does not know about in ``extra`` instead of dropping them
+keep_unknown_fields = False
+
+_unknown = object()
+
+
+def snowflake(value):
+    """
+    Convert a snowflake from a payload to the int it is stored as
+    :type value: str
+    :rtype: int
+    """
+    return int(value) if value is not None else None
+
+
+class Model:
+    """
+    Base for the compact data models.
+
+    Subclasses list the payload fields they keep in ``_fields`` (name -> default) and every field
+    holding a snowflake in ``_snowflakes``. Every field needs a slot; fields that need more than a copy
+    are left out of ``_fields`` and handled by the subclass. Payload keys a subclass handles under another
+    name than their own slot are listed in ``_handled_keys``, so they are not kept in ``extra``.
+    """
+    __slots__ = ('extra',)
+    _fields = {}
+    _snowflakes = frozenset()
+    _handled_keys = frozenset()
+    _converters = {}
+    _known_keys = frozenset()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # field name -> conversion applied when loading it, None to copy the value as is
+        cls._converters = {name: int if name in cls._snowflakes else None for name in cls._fields}
+        # the keys that are never unknown, even when they are not in _fields
+        cls._known_keys = frozenset(cls.__dict__.get('__slots__', ())) | cls._handled_keys
+
+    def _init_fields(self, data):
+        # Fields missing from the payload are not stored, __getattr__ falls back to their default
+        self._update_fields(data)
+
+    def __getattr__(self, name):
+        # only called when the slot was never set
+        try:
+            return self._fields[name]
+        except KeyError:
+            if name == 'extra':
+                return None
+            raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, name)) from None
+
+    def to_dict(self):
+        """
+        :return: The known fields in payload form, snowflakes as strings again
+        :rtype: dict
+        """
+        data = {}
+        for name, convert in self._converters.items():
+            value = getattr(self, name)
+            if convert is not None and value is not None:
+                value = str(value)
+            data[name] = value
+        return data
+
+    def _update_fields(self, data):
+        converters = self._converters
+        for key, value in data.items():
+            convert = converters.get(key, _unknown)
+            if convert is None:
+                setattr(self, key, value)
+            elif convert is not _unknown:
+                setattr(self, key, convert(value) if value is not None else None)
+            elif keep_unknown_fields and key not in self._known_keys:
+                if self.extra is None:
+                    self.extra = {}
+                self.extra[key] = value
@@ -0,0 +1,174 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+
+from darkPy import helpers, metrics
+
+log = helpers.setup_logger()
+
+# the kinds of connection a queue can belong to
+connections = ('main', 'voice')
+
+queue_depth = metrics.registry.gauge('darkpy_send_queue_depth', 'Payloads waiting in the outbound gateway queues',
+                                     ('connection',))
+queue_wait = {
+    connection: metrics.registry.histogram('darkpy_{}_send_queue_wait_seconds'.format(connection),
+                                           'Time payloads spent in the outbound {} gateway queue'.format(connection))
+    for connection in connections
+}
+coalesced = metrics.registry.counter('darkpy_send_queue_coalesced_total',
+                                     'Payloads replaced by a newer one before sending', ('connection',))
+
+PRIORITY_HEARTBEAT = 0
+PRIORITY_SESSION = 1
+PRIORITY_NORMAL = 2
+
+
+class _Entry:
+    __slots__ = ('priority', 'order', 'payload', 'key', 'futures', 'queued_at')
+
+    def __init__(self, priority, order, payload, key, future):
+        self.priority = priority
+        self.order = order
+        self.payload = payload
+        self.key = key
+        self.futures = [future]
+        self.queued_at = time.monotonic()
+
+    def __lt__(self, other):
+        return (self.priority, self.order) < (other.priority, other.order)
+
+
+class SendQueue:
+    """
+    Prioritized outbound queue for a single gateway connection.
+
+    Everything is written by one sender task, heartbeats first. The gateway allows ``limit`` payloads
+    per ``period`` seconds; ``reserved`` of those are kept free for heartbeats so a burst of other
+    payloads never gets us disconnected. Payloads sharing a coalesce key replace the one still waiting,
+    only the latest is sent.
+    """
+
+    def __init__(self, send, *, loop, limit=120, period=60.0, reserved=5, connection='main'):
+        """
+        :param connection: The kind of connection, one of ``connections``, the metrics are split by it
+        :type connection: str
+        """
+        self._send = send
+        self.connection = connection
+        self._labels = (connection,)
+        # this queue's part of the depth gauge, which is shared by every queue of its kind
+        self._reported_depth = 0
+        self.loop = loop
+        self.limit = limit
+        self.period = period
+        self.reserved = reserved
+        self._heap = []
+        self._pending = {}
+        self._order = itertools.count()
+        self._sent = deque()
+        self._wakeup = asyncio.Event(loop=loop)
+        self._task = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def start(self):
+        if self._task is None:
+            self._task = self.loop.create_task(self._sender())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        dropped = 0
+        for entry in self._heap:
+            for future in entry.futures:
+                if not future.done():
+                    future.set_result(None)
+                    dropped += 1
+        if dropped:
+            log.info('Dropped %s queued gateway payloads because the connection closed', dropped)
+        self._heap = []
+        self._pending.clear()
+        self._report_depth()
+
+    def put(self, payload, *, priority=PRIORITY_NORMAL, key=None):
+        """
+        Queue a payload for sending
+        :param payload: The JSON serializable payload
+        :type payload: dict
+        :param priority: Lower is sent earlier
+        :type priority: int
+        :param key: Payloads with the same key are coalesced, only the latest one is sent
+        :return: A future that is done once the payload (or the payload that replaced it) was sent
+        :rtype: asyncio.Future
+        """
+        future = asyncio.Future(loop=self.loop)
+        if key is not None:
+            entry = self._pending.get(key)
+            if entry is not None:
+                entry.payload = payload
+                entry.futures.append(future)
+                coalesced.inc(labels=self._labels)
+                return future
+
+        entry = _Entry(priority, next(self._order), payload, key, future)
+        heapq.heappush(self._heap, entry)
+        if key is not None:
+            self._pending[key] = entry
+        self._report_depth()
+        self._wakeup.set()
+        return future
+
+    def _report_depth(self):
+        depth = len(self._heap)
+        queue_depth.inc(depth - self._reported_depth, labels=self._labels)
+        self._reported_depth = depth
+
+    def _delay_for(self, priority):
+        now = time.monotonic()
+        while self._sent and self._sent[0] + self.period <= now:
+            self._sent.popleft()
+        limit = self.limit if priority == PRIORITY_HEARTBEAT else self.limit - self.reserved
+        if len(self._sent) < limit:
+            return 0
+        return self._sent[len(self._sent) - limit] + self.period - now
+
+    @asyncio.coroutine
+    def _sender(self):
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                yield from self._wakeup.wait()
+                continue
+
+            delay = self._delay_for(self._heap[0].priority)
+            if delay > 0:
+                # A heartbeat queued while we wait must not be held up behind the rate limit
+                self._wakeup.clear()
+                try:
+                    yield from asyncio.wait_for(self._wakeup.wait(), timeout=delay, loop=self.loop)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            entry = heapq.heappop(self._heap)
+            if entry.key is not None:
+                self._pending.pop(entry.key, None)
+            self._report_depth()
+            queue_wait[self.connection].observe(time.monotonic() - entry.queued_at)
+
+            self._sent.append(time.monotonic())
+            try:
+                yield from self._send(entry.payload)
+            except Exception as e:
+                for future in entry.futures:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for future in entry.futures:
+                    if not future.done():
+                        future.set_result(None)
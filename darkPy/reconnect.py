@@ -0,0 +1,86 @@
+import asyncio
+import random
+import time
+from collections import deque
+
+from darkPy import helpers, metrics
+
+log = helpers.setup_logger()
+
+
+class Backoff:
+    """
+    Capped exponential backoff with full jitter.
+    Every call to :meth:`delay` doubles the window the next delay is picked from, up to ``maximum``.
+    """
+
+    def __init__(self, base=1.0, maximum=60.0):
+        self.base = base
+        self.maximum = maximum
+        self._attempt = 0
+
+    def delay(self):
+        window = min(self.maximum, self.base * (2 ** self._attempt))
+        self._attempt += 1
+        return random.uniform(0, window)
+
+    def reset(self):
+        self._attempt = 0
+
+    @property
+    def attempts(self):
+        return self._attempt
+
+
+class ReconnectManager:
+    """
+    Bounds the amount of gateway and voice connections that are being (re)established at once
+    and keeps statistics about how reconnects went.
+    """
+
+    def __init__(self, *, loop=None, max_concurrent=1, history=100):
+        self.loop = asyncio.get_event_loop() if loop is None else loop
+        self.semaphore = asyncio.Semaphore(max_concurrent, loop=self.loop)
+        self.attempts = 0
+        self.reconnects = 0
+        self.resume_attempts = 0
+        self.resume_successes = 0
+        self.latencies = deque(maxlen=history)
+
+    def new_backoff(self):
+        return Backoff()
+
+    def record_attempt(self):
+        self.attempts += 1
+
+    def record_resume(self, success):
+        self.resume_attempts += 1
+        if success:
+            self.resume_successes += 1
+        metrics.resumes.inc(labels=('success' if success else 'failure',))
+
+    def record_connected(self, started, kind):
+        """
+        Record that a ``kind`` connection attempt which started at ``started`` (:func:`time.monotonic`) succeeded
+        :return: The time it took to connect in seconds
+        :rtype: float
+        """
+        latency = time.monotonic() - started
+        self.reconnects += 1
+        self.latencies.append(latency)
+        metrics.reconnects.inc(labels=(kind,))
+        return latency
+
+    @property
+    def resume_ratio(self):
+        """
+        :return: The fraction of RESUME attempts that succeeded, or None if we never tried to resume
+        :rtype: float
+        """
+        if self.resume_attempts == 0:
+            return None
+        return self.resume_successes / self.resume_attempts
+
+    @property
+    def last_latency(self):
+        return self.latencies[-1] if self.latencies else None
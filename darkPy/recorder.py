@@ -0,0 +1,76 @@
+import struct
+import time
+
+from darkPy import helpers
+
+log = helpers.setup_logger()
+
+# Every frame is stored as: kind (1 byte), receive time (double), payload length (uint32), payload
+_header = struct.Struct('<Bdi')
+FRAME_TEXT = 0
+FRAME_BINARY = 1
+
+
+class GatewayRecorder:
+    """
+    Writes every raw inbound gateway frame to a file, exactly as received.
+    Compressed frames are kept compressed so a replay pays the same decompression cost.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.frames = 0
+        self._file = open(path, 'ab')
+
+    def attach(self, client):
+        """
+        Start recording the frames the client receives
+        :type client: darkPy.client.Client
+        """
+        client.add_listener('socket_raw_receive', self.record)
+        log.info('Recording gateway traffic to %s', self.path)
+
+    def detach(self, client):
+        client.remove_listener('socket_raw_receive', self.record)
+
+    def record(self, msg):
+        if self._file is None:
+            return
+        if isinstance(msg, bytes):
+            kind = FRAME_BINARY
+            payload = msg
+        else:
+            kind = FRAME_TEXT
+            payload = msg.encode('utf-8')
+        self._file.write(_header.pack(kind, time.time(), len(payload)))
+        self._file.write(payload)
+        self.frames += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_recording(path):
+    """
+    Read all frames from a recording made by :class:`GatewayRecorder`
+    :param path: The recording file
+    :type path: str
+    :return: The frames in the form they were received, ``bytes`` or ``str``
+    :rtype: list
+    """
+    frames = []
+    with open(path, 'rb') as recording:
+        data = recording.read()
+    offset = 0
+    while offset + _header.size <= len(data):
+        kind, _, length = _header.unpack_from(data, offset)
+        offset += _header.size
+        payload = data[offset:offset + length]
+        offset += length
+        if len(payload) != length:
+            log.warning('Recording %s ends with a truncated frame', path)
+            break
+        frames.append(payload if kind == FRAME_BINARY else payload.decode('utf-8'))
+    return frames
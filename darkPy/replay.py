@@ -0,0 +1,160 @@
+"""
+Replays a gateway recording through :class:`MainGateway` and :class:`ConnectionState` without any network.
+
+Usage: python -m darkPy.replay <recording> [--repeat N] [--no-memory] [--production-logging]
+"""
+import argparse
+import asyncio
+import time
+import tracemalloc
+
+from darkPy import helpers
+from darkPy.gateway import MainGateway
+from darkPy.recorder import read_recording
+from darkPy.state import ConnectionState
+
+log = helpers.setup_logger()
+
+
+class ReplayGateway(MainGateway):
+    """A gateway that never touches the network and ignores the connection management opcodes"""
+    HELLO = None
+    INVALIDATE_SESSION = None
+
+    def __init__(self, client, loop):
+        # The websocket protocol is never set up, we only need the message handling
+        self.loop = loop
+        self._connection = client.connection
+        self._dispatch = client.dispatch
+        self._dispatch_listeners = []
+        self._keep_alive = _ReplayKeepAlive()
+
+    @asyncio.coroutine
+    def send_as_json(self, msg):
+        pass
+
+    @asyncio.coroutine
+    def close(self, *args, **kwargs):
+        pass
+
+
+class _ReplayKeepAlive:
+    def ack(self):
+        pass
+
+    def get_payload(self):
+        return {}
+
+
+class ReplayClient:
+    """Stands in for :class:`Client`, only keeps track of the type of the frame being handled"""
+
+    def __init__(self, loop, **state_options):
+        self.loop = loop
+        self.user = None
+        self.user_id = None
+        self.last_event = None
+        self.connection = ConnectionState(self, loop=loop, **state_options)
+
+    def dispatch(self, event, data):
+        if event == 'socket_response':
+            self.last_event = data.get('t') or 'op {}'.format(data.get('op'))
+
+
+def _drive(coro, loop):
+    # Handling a frame normally completes without suspending, so skip the event loop round trip
+    try:
+        coro.send(None)
+    except StopIteration:
+        return
+    coro.close()
+    raise RuntimeError('Replayed frame tried to wait on the event loop')
+
+
+def _run(frames, repeat, loop, state_options):
+    costs = {}
+    counts = {}
+    started = time.perf_counter()
+    for _ in range(repeat):
+        client = ReplayClient(loop, **state_options)
+        ws = ReplayGateway(client, loop)
+        for frame in frames:
+            frame_started = time.perf_counter()
+            _drive(ws.received_message(frame), loop)
+            cost = time.perf_counter() - frame_started
+            event = client.last_event
+            costs[event] = costs.get(event, 0.0) + cost
+            counts[event] = counts.get(event, 0) + 1
+    elapsed = time.perf_counter() - started
+    return elapsed, costs, counts, client
+
+
+def replay(frames, *, repeat=1, measure_memory=True, loop=None, **state_options):
+    """
+    Push recorded frames through the gateway as fast as possible
+    :param frames: Frames as returned by :func:`darkPy.recorder.read_recording`
+    :type frames: list
+    :param repeat: How often to replay the whole recording, every run starts with an empty state
+    :type repeat: int
+    :param measure_memory: Do an extra run under :mod:`tracemalloc` to find the peak memory use
+    :type measure_memory: bool
+    :param state_options: Keyword arguments passed to every :class:`ConnectionState`
+    :return: events, elapsed time, events/sec, per event type statistics and peak memory in bytes
+    :rtype: dict
+    """
+    loop = asyncio.new_event_loop() if loop is None else loop
+    elapsed, costs, counts, _ = _run(frames, repeat, loop, state_options)
+    total = sum(counts.values())
+
+    peak = None
+    if measure_memory:
+        tracemalloc.start()
+        try:
+            _, _, _, client = _run(frames, 1, loop, state_options)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    per_event = {
+        event: {'count': counts[event], 'total': costs[event], 'mean': costs[event] / counts[event]}
+        for event in counts
+    }
+    return {
+        'events': total,
+        'elapsed': elapsed,
+        'events_per_second': total / elapsed if elapsed > 0 else float('inf'),
+        'per_event': per_event,
+        'peak_memory': peak
+    }
+
+
+def format_report(report):
+    lines = ['{events} events in {elapsed:.3f}s ({events_per_second:.0f} events/sec)'.format(**report)]
+    if report['peak_memory'] is not None:
+        lines.append('peak memory: {:.1f} KiB'.format(report['peak_memory'] / 1024))
+    lines.append('{:<32} {:>8} {:>12} {:>12}'.format('event', 'count', 'total ms', 'mean us'))
+    ordered = sorted(report['per_event'].items(), key=lambda item: item[1]['total'], reverse=True)
+    for event, stats in ordered:
+        lines.append('{:<32} {:>8} {:>12.2f} {:>12.1f}'.format(
+            str(event), stats['count'], stats['total'] * 1000, stats['mean'] * 1000000))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded gateway traffic and report parse cost')
+    parser.add_argument('recording')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak memory measurement run')
+    parser.add_argument('--production-logging', action='store_true')
+    args = parser.parse_args()
+
+    if args.production_logging:
+        helpers.enable_production_logging()
+    frames = read_recording(args.recording)
+    report = replay(frames, repeat=args.repeat, measure_memory=not args.no_memory)
+    print(format_report(report))
+    helpers.disable_production_logging()
+
+
+if __name__ == '__main__':
+    main()
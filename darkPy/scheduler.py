@@ -0,0 +1,164 @@
+import asyncio
+from collections import deque
+
+from darkPy import helpers, metrics
+
+log = helpers.setup_logger()
+
+command_outcomes = metrics.registry.counter('darkpy_commands_total', 'Commands by what happened to them', ('outcome',))
+commands_queued = metrics.registry.gauge('darkpy_commands_queued', 'Commands waiting for their guild to be free')
+
+
+class CommandOptions:
+    __slots__ = ('cooldown', 'coalesce', 'priority')
+
+    def __init__(self, cooldown=0.0, coalesce=False, priority=False):
+        """
+        :param cooldown: Seconds a user has to wait before using the command again
+        :type cooldown: float
+        :param coalesce: A newer call replaces the one still queued in the same guild, only the latest runs
+        :type coalesce: bool
+        :param priority: Run before anything queued in the guild, dropping the queued commands
+        :type priority: bool
+        """
+        self.cooldown = cooldown
+        self.coalesce = coalesce
+        self.priority = priority
+
+
+class _Job:
+    __slots__ = ('name', 'func', 'args', 'message', 'options')
+
+    def __init__(self, name, func, args, message, options):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.message = message
+        self.options = options
+
+
+class _Lane:
+    __slots__ = ('jobs', 'worker', 'generation')
+
+    def __init__(self):
+        self.jobs = deque()
+        self.worker = None
+        # bumped when a priority command drops the queue, so a command that was already taken off it knows too
+        self.generation = 0
+
+
+class CommandScheduler:
+    """
+    Runs commands one at a time per guild.
+
+    Commands of different guilds run concurrently, up to ``max_in_flight`` at once. Per command a cooldown per
+    user, coalescing of superseded calls and a priority lane can be configured, see :class:`CommandOptions`.
+    """
+
+    def __init__(self, *, loop, max_in_flight=8, max_queued=5):
+        """
+        :param max_in_flight: The maximum amount of commands running at the same time over all guilds
+        :type max_in_flight: int
+        :param max_queued: The maximum amount of commands waiting per guild, newer ones are dropped
+        :type max_queued: int
+        """
+        self.loop = loop
+        self.max_queued = max_queued
+        self.in_flight = asyncio.Semaphore(max_in_flight, loop=loop)
+        self.options = {}
+        self._default = CommandOptions()
+        self._lanes = {}
+        # (user id, command) -> time the command was last accepted
+        self._last_used = {}
+        commands_queued.set_function(
+            lambda scheduler: sum(len(lane.jobs) for lane in list(scheduler._lanes.values())), owner=self)
+
+    def configure(self, name, **options):
+        """
+        Set the scheduling options of a command, see :class:`CommandOptions` for what can be set
+        :type name: str
+        """
+        self.options[name] = CommandOptions(**options)
+
+    def submit(self, name, func, args, message, key):
+        """
+        Queue a command
+
+        :param name: The name of the command
+        :type name: str
+        :param func: The coroutine function handling it, called with ``args`` and ``message``
+        :param key: What the command is serialized on, normally the guild id
+        :return: Whether the command was accepted
+        :rtype: bool
+        """
+        options = self.options.get(name, self._default)
+        if options.cooldown and self._on_cooldown(message.author.id, name, options.cooldown):
+            command_outcomes.inc(labels=('cooldown',))
+            return False
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = _Lane()
+        job = _Job(name, func, args, message, options)
+        if options.priority:
+            if lane.jobs:
+                command_outcomes.inc(len(lane.jobs), labels=('preempted',))
+                lane.jobs.clear()
+            lane.generation += 1
+            lane.jobs.append(job)
+        else:
+            if options.coalesce:
+                superseded = [queued for queued in lane.jobs if queued.name == name]
+                for queued in superseded:
+                    lane.jobs.remove(queued)
+                if superseded:
+                    command_outcomes.inc(len(superseded), labels=('coalesced',))
+            if len(lane.jobs) >= self.max_queued:
+                command_outcomes.inc(labels=('dropped',))
+                log.info('Dropped command %s, too many commands queued for %s', name, key)
+                return False
+            lane.jobs.append(job)
+        if lane.worker is None:
+            lane.worker = self.loop.create_task(self._run_lane(key, lane))
+        return True
+
+    def _on_cooldown(self, user_id, name, cooldown):
+        now = self.loop.time()
+        last = self._last_used.get((user_id, name))
+        if last is not None and now - last < cooldown:
+            return True
+        self._last_used[(user_id, name)] = now
+        if len(self._last_used) > 10000:
+            # forget the users whose cooldowns have run out
+            longest = max(options.cooldown for options in self.options.values())
+            self._last_used = {used: at for used, at in self._last_used.items() if now - at < longest}
+        return False
+
+    @asyncio.coroutine
+    def _run_lane(self, key, lane):
+        try:
+            while lane.jobs:
+                job = lane.jobs.popleft()
+                if job.options.priority:
+                    # not held back by the commands of other guilds
+                    yield from self._run(job)
+                    continue
+                generation = lane.generation
+                with (yield from self.in_flight):
+                    if generation != lane.generation:
+                        command_outcomes.inc(labels=('preempted',))
+                        continue
+                    yield from self._run(job)
+        finally:
+            lane.worker = None
+            if not lane.jobs:
+                self._lanes.pop(key, None)
+
+    @asyncio.coroutine
+    def _run(self, job):
+        command_outcomes.inc(labels=('run',))
+        try:
+            yield from job.func(job.args, job.message)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception('Command %s failed', job.name)
@@ -0,0 +1,74 @@
+import json
+import os
+import time
+
+from darkPy import helpers
+
+log = helpers.setup_logger()
+
+
+class SessionStore:
+    """
+    Keeps the gateway session on disk so a restarted process can RESUME instead of IDENTIFY.
+    The file is replaced atomically, a crash while saving leaves the previous session intact.
+    """
+    version = 1
+
+    def __init__(self, path, *, max_age=120.0):
+        """
+        :param path: The file the session is stored in
+        :type path: str
+        :param max_age: Sessions saved longer ago than this many seconds are not resumed anymore
+        :type max_age: float
+        """
+        self.path = path
+        self.max_age = max_age
+
+    def load(self):
+        """
+        :return: The stored session, or None if there is none or it is too old to resume
+        :rtype: dict
+        """
+        try:
+            with open(self.path, 'r') as session_file:
+                data = json.load(session_file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            log.warning('Could not read the stored session from %s: %r', self.path, e)
+            return None
+
+        if data.get('version') != self.version:
+            return None
+        age = time.time() - data.get('saved_at', 0)
+        if age > self.max_age:
+            log.info('Stored session is %.0fs old, not resuming it', age)
+            return None
+        return data
+
+    def save(self, session_id, sequence, gateway, snapshot=None):
+        """
+        Blocks on disk I/O, run it in an executor from the event loop
+        :param snapshot: The state snapshot, already encoded to json
+        :type snapshot: str
+        """
+        data = {
+            'version': self.version,
+            'saved_at': time.time(),
+            'session_id': session_id,
+            'sequence': sequence,
+            'gateway': gateway
+        }
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as session_file:
+            session_file.write(json.dumps(data, separators=(',', ':'))[:-1])
+            session_file.write(',"snapshot":')
+            session_file.write(snapshot if snapshot is not None else 'null')
+            session_file.write('}')
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
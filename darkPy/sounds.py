@@ -0,0 +1,264 @@
+import asyncio
+import bisect
+import difflib
+import json
+import os
+
+from darkPy import helpers, loudness
+
+log = helpers.setup_logger()
+
+audio_extensions = ('.wav', '.mp3', '.ogg', '.opus', '.flac', '.m4a', '.webm')
+
+
+class Sound:
+    __slots__ = ('name', 'path', 'duration', 'format', 'size', 'mtime', 'loudness', 'gain', 'start', 'end')
+
+    def __init__(self, name, path, duration, format, size, mtime, loudness=None, gain=1.0, start=0.0, end=None):
+        self.name = name
+        self.path = path
+        # seconds, None when the clip could not be decoded
+        self.duration = duration
+        self.format = format
+        self.size = size
+        self.mtime = mtime
+        # measured once at ingest, see darkPy.loudness
+        self.loudness = loudness
+        self.gain = gain
+        # the part of the clip between the silence at both ends, in seconds
+        self.start = start
+        self.end = end
+
+    def __repr__(self):
+        return '<Sound name={0.name!r} format={0.format} duration={0.duration}>'.format(self)
+
+    def player_options(self):
+        """
+        :return: Keyword arguments for VoiceClient.create_ffmpeg_player that play the trimmed clip at its gain,
+            so nothing has to be done per frame while playing
+        :rtype: dict
+        """
+        options = []
+        if self.end is not None:
+            options.append('-t {:.3f}'.format(self.end - self.start))
+        if self.gain != 1.0:
+            options.append('-af volume={:.4f}'.format(self.gain))
+        return {
+            'before_options': '-ss {:.3f}'.format(self.start) if self.start else None,
+            'options': ' '.join(options) or None
+        }
+
+    def _sidecar_entry(self):
+        return {'size': self.size, 'mtime': self.mtime, 'duration': self.duration, 'loudness': self.loudness,
+                'gain': self.gain, 'start': self.start, 'end': self.end}
+
+
+def _trigrams(name):
+    padded = '  ' + name + ' '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class _Index:
+    """Immutable lookup structures over a manifest, rebuilt and swapped as a whole when the manifest changes"""
+    __slots__ = ('sounds', 'names', 'trigrams')
+
+    def __init__(self, sounds):
+        # lowercased name -> Sound
+        self.sounds = sounds
+        self.names = sorted(sounds)
+        self.trigrams = {}
+        for name in self.names:
+            for trigram in _trigrams(name):
+                self.trigrams.setdefault(trigram, []).append(name)
+
+
+class SoundLibrary:
+    """
+    In-memory manifest of the sound clips in a directory.
+
+    The directory is scanned in the background on start and then checked for changes every ``interval`` seconds,
+    both from an executor. Only new and changed files are probed again. Looking up a clip never touches the filesystem.
+    """
+
+    def __init__(self, directory, *, loop, interval=5.0, cutoff=0.8):
+        """
+        :param directory: The directory with the clips, the file name without extension is the name of a clip
+        :type directory: str
+        :param interval: Seconds between checks for changed files
+        :type interval: float
+        :param cutoff: How similar a name has to be to a clip for :meth:`find` to pick it, from 0 to 1
+        :type cutoff: float
+        """
+        self.directory = directory
+        self.loop = loop
+        self.interval = interval
+        self.cutoff = cutoff
+        self._index = _Index({})
+        # the analysis of every clip is kept next to them, so it is only done once per clip
+        self.sidecar = os.path.join(directory, '.sounds.json')
+        self._sidecar = None
+        self._task = None
+
+    def __len__(self):
+        return len(self._index.sounds)
+
+    def __iter__(self):
+        return iter(self._index.sounds.values())
+
+    def start(self):
+        """
+        Scan and analyse the clips in the background, so the client does not wait for it to log in. Until the
+        first scan is done the library is empty.
+        """
+        self._task = self.loop.create_task(self._watch())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    @asyncio.coroutine
+    def refresh(self):
+        """Scan the directory again, the manifest is swapped in one assignment when something changed"""
+        index = yield from self.loop.run_in_executor(None, self._scan, self._index)
+        if index is not None:
+            self._index = index
+
+    @asyncio.coroutine
+    def _watch(self):
+        loaded = False
+        while True:
+            try:
+                yield from self.refresh()
+            except OSError as e:
+                log.warning('Could not scan %s: %r', self.directory, e)
+            else:
+                if not loaded:
+                    loaded = True
+                    log.info('Loaded %s sounds from %s', len(self), self.directory)
+            yield from asyncio.sleep(self.interval, loop=self.loop)
+
+    def get(self, name):
+        """
+        :return: The clip with exactly this name, case insensitive, or None
+        :rtype: Sound
+        """
+        return self._index.sounds.get(name.lower())
+
+    def prefix(self, prefix):
+        """
+        :return: The clips whose name starts with ``prefix``, in name order
+        :rtype: list
+        """
+        index = self._index
+        prefix = prefix.lower()
+        start = bisect.bisect_left(index.names, prefix)
+        matches = []
+        for name in index.names[start:]:
+            if not name.startswith(prefix):
+                break
+            matches.append(index.sounds[name])
+        return matches
+
+    def suggest(self, name, limit=3, cutoff=0.6):
+        """
+        Fuzzy match a name against the clips
+
+        :return: Up to ``limit`` (score, Sound) pairs with a score of at least ``cutoff``, best first
+        :rtype: list
+        """
+        index = self._index
+        name = name.lower()
+        shared = {}
+        for trigram in _trigrams(name):
+            for candidate in index.trigrams.get(trigram, ()):
+                shared[candidate] = shared.get(candidate, 0) + 1
+        # only score the names sharing the most trigrams, the rest can not be close
+        candidates = sorted(shared, key=shared.get, reverse=True)[:20]
+        scored = []
+        for candidate in candidates:
+            score = difflib.SequenceMatcher(None, name, candidate).ratio()
+            if score >= cutoff:
+                scored.append((score, index.sounds[candidate]))
+        scored.sort(key=lambda pair: pair[0], reverse=True)
+        return scored[:limit]
+
+    def find(self, name):
+        """
+        Resolve what a user typed to a clip: an exact name, a unique prefix or a close enough typo
+
+        :return: The clip or None
+        :rtype: Sound
+        """
+        sound = self.get(name)
+        if sound is not None:
+            return sound
+        matches = self.prefix(name)
+        if len(matches) == 1:
+            return matches[0]
+        suggestions = self.suggest(name, limit=1, cutoff=self.cutoff)
+        if suggestions:
+            return suggestions[0][1]
+        return None
+
+    def _scan(self, previous):
+        """
+        Runs in an executor
+        :return: The new index, or None when nothing changed
+        :rtype: _Index
+        """
+        if self._sidecar is None:
+            self._sidecar = self._load_sidecar()
+        sounds = {}
+        changed = False
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                base, extension = os.path.splitext(entry.name)
+                if extension.lower() not in audio_extensions or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                key = base.lower()
+                known = previous.sounds.get(key)
+                if known is not None and known.path == entry.path and known.mtime == stat.st_mtime_ns \
+                        and known.size == stat.st_size:
+                    sounds[key] = known
+                    continue
+                changed = True
+                sounds[key] = self._ingest(base, entry.name, entry.path, extension, stat)
+        if not changed and len(sounds) == len(previous.sounds):
+            return None
+        self._sidecar = {os.path.basename(sound.path): sound._sidecar_entry() for sound in sounds.values()}
+        self._save_sidecar()
+        return _Index(sounds)
+
+    def _ingest(self, name, filename, path, extension, stat):
+        stored = self._sidecar.get(filename)
+        if stored is not None and stored['mtime'] == stat.st_mtime_ns and stored['size'] == stat.st_size:
+            return Sound(name, path, stored['duration'], extension[1:].lower(), stat.st_size, stat.st_mtime_ns,
+                         stored['loudness'], stored['gain'], stored['start'], stored['end'])
+        analysis = loudness.analyse_file(path)
+        if analysis is None:
+            return Sound(name, path, None, extension[1:].lower(), stat.st_size, stat.st_mtime_ns)
+        log.debug('Analysed %s: %s dBFS, gain %.2f, playing %.2fs to %.2fs', filename, analysis.loudness,
+                  analysis.gain, analysis.start, analysis.end)
+        return Sound(name, path, analysis.duration, extension[1:].lower(), stat.st_size, stat.st_mtime_ns,
+                     analysis.loudness, analysis.gain, analysis.start, analysis.end)
+
+    def _load_sidecar(self):
+        try:
+            with open(self.sidecar, 'r') as sidecar:
+                return json.load(sidecar)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            log.warning('Could not read %s, analysing every clip again: %r', self.sidecar, e)
+            return {}
+
+    def _save_sidecar(self):
+        tmp_path = self.sidecar + '.tmp'
+        try:
+            with open(tmp_path, 'w') as sidecar:
+                json.dump(self._sidecar, sidecar)
+            os.replace(tmp_path, self.sidecar)
+        except OSError as e:
+            log.warning('Could not write %s: %r', self.sidecar, e)
@@ -1,25 +1,76 @@
-from darkPy.guild import Guild
+import asyncio
+import json
+
+from darkPy import metrics
+from darkPy.cache import CacheDisabled, CachePolicy, DisabledCache, MessageCache
+from darkPy.guild import Guild, encode_snapshot
+from darkPy.members import MemberRequester
+from darkPy.model import snowflake
 from darkPy.message import Message
-from darkPy.user import User
+from darkPy.user import UserCache, make_user
 
 
 class ConnectionState:
-    def __init__(self, client, *, loop=None):
+    def __init__(self, client, *, loop=None, member_cache_size=1000, preload_members=False, check_consistency=False,
+                 max_messages=5000, max_messages_per_channel=100, cache_policy=None):
+        """
+        :param cache_policy: Which categories are cached, everything when not given
+        :type cache_policy: darkPy.cache.CachePolicy
+        :param max_messages: The maximum amount of messages cached over all channels, None for no limit
+        :type max_messages: int
+        :param max_messages_per_channel: The maximum amount of messages cached per channel, None for no limit
+        :type max_messages_per_channel: int
+        :param check_consistency: Verify the channel indexes after every change, slow and only meant for testing
+        :type check_consistency: bool
+        """
         self.client = client
         self.loop = loop
         self.guilds = {}
-        self.channels = {}
+        # channel id -> guild, so routing a message does not depend on the amount of guilds. The channel objects
+        # themselves live in the guilds, which only build them when first needed
+        self._channel_guilds = {}
+        self.check_consistency = check_consistency
+        self.cache_policy = policy = CachePolicy() if cache_policy is None else cache_policy
+        if policy.messages:
+            self.message_cache = MessageCache(max_messages, max_messages_per_channel)
+        else:
+            self.message_cache = DisabledCache('messages')
+        self.users = UserCache() if policy.users else None
+        self._guild_options = {
+            'member_cache_size': member_cache_size,
+            'preload_members': preload_members,
+            'message_cache': self.message_cache,
+            'users': self.users,
+            'policy': policy
+        }
+        self.member_requests = MemberRequester(self, loop=loop)
         self.clear()
 
+        metrics.cache_size.set_function(lambda state: len(state.guilds), ('guilds',), owner=self)
+        metrics.cache_size.set_function(lambda state: len(state._channel_guilds), ('channels',), owner=self)
+        metrics.cache_size.set_function(lambda state: len(state.voice_clients), ('voice_clients',), owner=self)
+        metrics.cache_size.set_function(
+            lambda state: sum(guild.cached_member_count for guild in list(state.guilds.values())), ('members',),
+            owner=self)
+        metrics.cache_size.set_function(lambda state: len(state.message_cache), ('messages',), owner=self)
+        metrics.cache_size.set_function(lambda state: len(state.users or ()), ('users',), owner=self)
+
     def clear(self):
         self.user = None
         self.sequence = None
         self.session_id = None
+        for guild in self.guilds.values():
+            guild.clear_messages()
         self.guilds.clear()
+        self._channel_guilds.clear()
         self.voice_clients = {}
+        # the pooled connections were part of the dropped voice clients
+        voice_pool = getattr(self.client, 'voice_pool', None)
+        if voice_pool is not None:
+            voice_pool.clear()
 
     def parse_ready(self, data):
-        self.user = User(data['user'])
+        self.user = make_user(data['user'], self.users)
         self.client.user_id = self.user.id
         self.client.user = self.user
 
@@ -27,120 +78,251 @@ class ConnectionState:
         pass
 
     def parse_guild_create(self, data):
-        guild = Guild(data)
+        guild = Guild(data, **self._guild_options)
         self._add_guild(guild)
 
     def parse_guild_update(self, data):
-        newGuild = Guild(data)
-        self._set_guild(newGuild)
+        guild = self.guilds.get(snowflake(data['id']))
+        if guild is None:
+            self._add_guild(Guild(data, **self._guild_options))
+            return
+        guild.update(data)
 
     def parse_guild_delete(self, data):
-        self._remove_guild(data['id'])
+        self._remove_guild(snowflake(data['id']))
 
     def parse_emojis_update(self, data):
         guild = self.get_guild(data['guild_id'])
         guild.set_emojis(data['emojis'])
 
     def parse_guild_member_add(self, data):
+        if not self.cache_policy.members:
+            return
         guild = self.get_guild(data['guild_id'])
         data['guild_id'] = None
         guild.add_member(data)
 
     def parse_guild_member_remove(self, data):
+        if not self.cache_policy.members:
+            return
         guild = self.get_guild(data['guild_id'])
-        guild.remove_member(data['user']['id'])
+        guild.remove_member(snowflake(data['user']['id']))
 
     def parse_guild_member_update(self, data):
+        if not self.cache_policy.members:
+            return
         guild = self.get_guild(data['guild_id'])
         data['guild_id'] = None
         guild.update_member(data)
 
+    def parse_guild_members_chunk(self, data):
+        guild = self.guilds.get(snowflake(data['guild_id']))
+        if guild is None:
+            return
+        members = {}
+        for memberData in data.get('members', []):
+            member = guild.add_member(memberData)
+            members[member.user.id] = member
+        last = data.get('chunk_index', 0) + 1 >= data.get('chunk_count', 1)
+        self.member_requests.chunk_received(guild.id, data.get('nonce'), members, [snowflake(user_id) for user_id in data.get('not_found', [])], last)
+
     def parse_message_create(self, data):
-        message = Message(data)
-        guild = self._get_guild_for_channel(message.channel_id)
-        guild.channels[message.channel_id].add_message(message)
+        message = Message(data, self.users)
+        if self.cache_policy.messages:
+            channel = self._lookup_channel(message.channel_id)
+            if channel is not None:
+                channel.add_message(message)
         self.client.dispatch('message_create', message)
 
     def parse_message_update(self, data):
-        guild = self._get_guild_for_channel(data['channel_id'])
-        channel = guild.channels.get(data['channel_id'], None)
+        if not self.cache_policy.messages:
+            return
+        channel = self._lookup_channel(snowflake(data['channel_id']))
         if channel:
             channel.update_message(data)
-            self.client.dispatch('message_update', channel.get_message(data['id']))
+            self.client.dispatch('message_update', channel.get_message(snowflake(data['id'])))
 
     def parse_message_delete(self, data):
-        guild = self._get_guild_for_channel(data['channel_id'])
-        channel = guild.channels.get(data['channel_id'], None)
+        if not self.cache_policy.messages:
+            return
+        channel = self._lookup_channel(snowflake(data['channel_id']))
         if channel:
-            channel.remove_message(data['id'])
+            channel.remove_message(snowflake(data['id']))
 
     def parse_message_delete_bulk(self, data):
-        guild = self._get_guild_for_channel(data['channel_id'])
-        channel = guild.channels.get(data['channel_id'], None)
+        if not self.cache_policy.messages:
+            return
+        channel = self._lookup_channel(snowflake(data['channel_id']))
         if channel:
             for id in data['ids']:
-                channel.remove_message(id)
+                channel.remove_message(snowflake(id))
 
     def parse_channel_create(self, data):
-        guild = self.get_guild(data['guild_id'])
+        guild = self.guilds.get(snowflake(data.get('guild_id')))
+        if guild is None:
+            return
         guild.add_channel(data)
+        self._channel_guilds[snowflake(data['id'])] = guild
+        if self.check_consistency:
+            self._verify_indexes()
 
     def parse_channel_update(self, data):
-        guild = self.get_guild(data['guild_id'])
+        guild = self.guilds.get(snowflake(data.get('guild_id')))
+        if guild is None:
+            return
         guild.update_channel(data)
+        self._channel_guilds[snowflake(data['id'])] = guild
+        if self.check_consistency:
+            self._verify_indexes()
 
     def parse_channel_delete(self, data):
-        guild = self.get_guild(data['guild_id'])
-        guild.remove_channel(data['guild_id'])
+        guild = self.guilds.get(snowflake(data.get('guild_id')))
+        if guild is None:
+            return
+        channel_id = snowflake(data['id'])
+        guild.remove_channel(channel_id)
+        self._unindex_channel(channel_id)
+        if self.check_consistency:
+            self._verify_indexes()
 
     def parse_voice_state_update(self, data):
-        channel = self.get_channel(data.get('channel_id'))
-        if channel is None:
-            guild = self.get_guild(data.get('guild_id'))
-            guild.remove_voice_user(data)
+        guild = self.guilds.get(snowflake(data.get('guild_id')))
+        if guild is None:
             return
-        guild = channel.guild
-        guild.remove_voice_user(data)
-        channel.add_voice_user(data)
+        guild.update_voice_state(data)
+
+    def snapshot(self):
+        """
+        :return: The state needed to pick up a resumed session in a new process, see :meth:`encode_snapshot`
+        :rtype: dict
+        """
+        return {
+            'user': self.user.to_dict() if self.user is not None else None,
+            'guilds': [guild.snapshot() for guild in self.guilds.values()]
+        }
+
+    @staticmethod
+    def encode_snapshot(snapshot):
+        """
+        Encode a snapshot to json, this takes a while with many guilds and is meant to run in an executor
+        :rtype: str
+        """
+        guilds = ','.join(encode_snapshot(guild) for guild in snapshot['guilds'])
+        return '{{"user":{},"guilds":[{}]}}'.format(json.dumps(snapshot['user'], separators=(',', ':')), guilds)
+
+    def restore(self, session):
+        """
+        Load a session stored by :class:`darkPy.session_store.SessionStore`, ready to RESUME it
+        :param session: The stored session with its snapshot
+        :type session: dict
+        """
+        self.clear()
+        snapshot = session['snapshot']
+        self.parse_ready({'user': snapshot['user']})
+        for guildData in snapshot['guilds']:
+            self.parse_guild_create(guildData)
+        self.session_id = session['session_id']
+        self.sequence = session['sequence']
+
     def _add_guild(self, guild):
         if self.guilds.get(guild.id, None) is None:
             self._set_guild(guild)
 
     def _set_guild(self, guild):
+        old = self.guilds.get(guild.id)
+        if old is not None:
+            old.clear_messages()
+            for channel_id in old.channel_ids:
+                self._unindex_channel(channel_id)
+            for channel_id in old.uncached_channels:
+                self._unindex_channel(channel_id)
         self.guilds[guild.id] = guild
-        channels = guild.channels
-        for channel in channels:
-            self.channels[channel] = guild.channels[channel]
+        for channel_id in guild.channel_ids:
+            self._channel_guilds[channel_id] = guild
+        for channel_id in guild.uncached_channels:
+            self._channel_guilds[channel_id] = guild
+        if self.check_consistency:
+            self._verify_indexes()
+
+    def _unindex_channel(self, channel_id):
+        self._channel_guilds.pop(channel_id, None)
+
+    def _lookup_channel(self, channel_id):
+        guild = self._channel_guilds.get(channel_id)
+        if guild is None or channel_id not in guild.channel_ids:
+            return None
+        return guild.channels.get(channel_id)
+
+    def _verify_indexes(self):
+        """
+        Rebuild the channel indexes from the guilds and compare them with the maintained ones
+        :raises RuntimeError: if the indexes do not match the guilds
+        """
+        expected = {}
+        for guild in self.guilds.values():
+            for channel_id in guild.channel_ids:
+                expected[channel_id] = guild
+            for channel_id in guild.uncached_channels:
+                expected[channel_id] = guild
+            # only check built channels, checking would build them otherwise
+            if guild._channels is not None and set(guild._channels) != guild.channel_ids:
+                raise RuntimeError('Guild {} has channels {}, but indexes {}'
+                                   .format(guild.id, sorted(guild._channels), sorted(guild.channel_ids)))
+        if expected != self._channel_guilds:
+            raise RuntimeError('Channel index out of sync: {} indexed, {} expected'
+                               .format(sorted(self._channel_guilds), sorted(expected)))
 
     def get_guild(self, guildid):
         """
 
         :param guildid: The guild ID to retrieve
-        :type guildid: str
+        :type guildid: int
         :return: The guild object
         :rtype: Guild
         """
-        return self.guilds[guildid]
+        return self.guilds[snowflake(guildid)]
 
     def _remove_guild(self, guildid):
-        channels = self.get_guild(guildid).channels
-        for channel in channels:
-            self.channels.pop(channel)
-        self.guilds.pop(guildid)
+        guild = self.guilds.pop(guildid, None)
+        if guild is None:
+            return
+        guild.clear_messages()
+        for channel_id in guild.channel_ids:
+            self._unindex_channel(channel_id)
+        for channel_id in guild.uncached_channels:
+            self._unindex_channel(channel_id)
+        if self.check_consistency:
+            self._verify_indexes()
 
     def _get_guild_for_channel(self, channel_id):
         """
 
         :param channel_id: The channel id we want the guild for
-        :type channel_id: str
+        :type channel_id: int
         :return: The guild corresponding or None if the guild does not exist
         :rtype: Guild
         """
-        for guild in self.guilds:
-            guild_obj = self.guilds[guild]
-            if guild_obj.channels.get(channel_id, None):
-                return guild_obj
-        return None
+        return self._channel_guilds.get(channel_id)
+
+    @asyncio.coroutine
+    def fetch_member(self, guild_id, user_id):
+        """
+        Get a member from the cache, or request it from the gateway
+
+        :param guild_id: The guild the member is in
+        :type guild_id: int
+        :param user_id: The user id of the member
+        :type user_id: int
+        :return: The member or None if the user is not in the guild
+        :rtype: darkPy.guild.Member
+        """
+        guild = self.get_guild(guild_id)
+        user_id = snowflake(user_id)
+        if self.cache_policy.members:
+            member = guild.get_member(user_id)
+            if member is not None:
+                return member
+        return (yield from self.member_requests.fetch(guild.id, user_id))
 
     def _get_voice_client(self, guild_id):
         return self.voice_clients.get(guild_id)
@@ -152,15 +334,21 @@ class ConnectionState:
         self.voice_clients.pop(guild_id, None)
 
     def _update_references(self, ws):
-        for vc in self.voice_clients:
+        for vc in self.voice_clients.values():
             vc.main_ws = ws
 
     def get_channel(self, channel_id):
         """
 
         :param channel_id: The channel id to search for
-        :type channel_id: str
+        :type channel_id: int
         :return: The channel object with the specified id
         :rtype: darkPy.channel.Channel
+        :raises CacheDisabled: if the channel exists but the cache policy does not keep it
         """
-        return self.channels.get(channel_id, None)
+        channel_id = snowflake(channel_id)
+        channel = self._lookup_channel(channel_id)
+        if channel is None and channel_id in self._channel_guilds:
+            raise CacheDisabled('Channel {} is not cached, the cache policy only keeps voice channels'
+                                .format(channel_id))
+        return channel
@@ -1,10 +1,66 @@
-class User:
+import weakref
+
+from darkPy.model import Model
+
+
+class User(Model):
+    __slots__ = ('id', 'username', 'discriminator', 'avatar', 'bot', 'mfa_enabled', 'verified', 'email',
+                 '__weakref__')
+    _fields = {
+        'id': None,
+        'username': None,
+        'discriminator': None,
+        'avatar': None,
+        'bot': False,
+        'mfa_enabled': False,
+        'verified': False,
+        'email': ""
+    }
+    _snowflakes = frozenset(('id',))
+
     def __init__(self, data):
-        self.id = data['id']
-        self.username = data['username']
-        self.discriminator = data['discriminator']
-        self.avatar = data.get('avatar', None)
-        self.bot = data.get('bot', False)
-        self.mfa_enabled = data.get('mfa_enabled', False)
-        self.verified = data.get('verified', False)
-        self.email = data.get('email', "")
\ No newline at end of file
+        self._init_fields(data)
+
+    def update(self, data):
+        self._update_fields(data)
+
+
+class UserCache:
+    """
+    Interns :class:`User` objects by id, so a user seen in many guilds or messages exists only once.
+    Users are held weakly and disappear once no member or cached message refers to them anymore.
+    """
+
+    def __init__(self):
+        self._users = weakref.WeakValueDictionary()
+
+    def __len__(self):
+        return len(self._users)
+
+    def get(self, user_id):
+        return self._users.get(user_id)
+
+    def intern(self, data):
+        """
+        Get the user for a payload, updating the existing one in place with the newer data
+        :param data: A user payload
+        :type data: dict
+        :rtype: User
+        """
+        user_id = int(data['id'])
+        user = self._users.get(user_id)
+        if user is None:
+            user = User(data)
+            self._users[user_id] = user
+        else:
+            user.update(data)
+        return user
+
+
+def make_user(data, users=None):
+    """
+    :param users: The cache to intern the user in, a new unshared user is created without one
+    :type users: UserCache
+    :rtype: User
+    """
+    return User(data) if users is None else users.intern(data)
@@ -12,11 +12,22 @@ import time
 
 from websockets import ConnectionClosed
 
-from darkPy import opus, helpers
+from darkPy import opus, helpers, metrics
 from darkPy.channel import ChannelType
 from darkPy.gateway import VoiceGateway
+from darkPy.model import snowflake
+from darkPy.reconnect import ReconnectManager
 
 log = helpers.setup_logger()
+_drop_sampler = helpers.LogSampler(1)
+
+# the phases of joining a voice channel, in order
+join_phases = ('gateway', 'resolve', 'websocket', 'ip_discovery', 'session', 'total')
+_join_histograms = {
+    phase: metrics.registry.histogram('darkpy_voice_join_{}_seconds'.format(phase),
+                                      'Time spent in the {} phase of joining a voice channel'.format(phase))
+    for phase in join_phases
+}
 
 try:
     import nacl.secret
@@ -26,8 +37,13 @@ except ImportError:
 
 
 class StreamPlayer(threading.Thread):
-    def __init__(self, stream, encoder, connected, player, after, **kwargs):
+    def __init__(self, stream, encoder, connected, player, after, encoding=None, **kwargs):
+        """
+        :param encoding: Encode in a worker process instead of this thread, see :class:`darkPy.encoding.EncoderPool`
+        :type encoding: darkPy.encoding.PooledStream
+        """
         threading.Thread.__init__(self, **kwargs)
+        self.encoding = encoding
         self.daemon = True
         self.buff = stream
         self.frame_size = encoder.frame_size
@@ -40,6 +56,10 @@ class StreamPlayer(threading.Thread):
         self._delay = encoder.frame_length / 1000.0
         self._volume = 1.0
         self._current_error = None
+        # records the packets into the audio cache, set before the player is started
+        self.cache_writer = None
+        # the stream was played to its end
+        self._completed = False
 
         if after is not None and not callable(after):
             raise TypeError('Expected a callable of for the after parameter.')
@@ -64,24 +84,92 @@ class StreamPlayer(threading.Thread):
                 data = audioop.mul(data, 2, min(self.volume, 2.0))
 
             if len(data) != self.frame_size:
+                self._completed = True
+                self.stop()
+                break
+
+            packet = self.player(data)
+            if self.cache_writer is not None:
+                self._record(packet)
+            next_time = self._start + self._delay * self.loops
+            delay = max(0, self._delay + (next_time - time.time()))
+            time.sleep(delay)
+
+    def _do_run_pooled(self):
+        """
+        Like _do_run, but with the frames encoded by a worker process. The frames are read ahead, so the
+        packet of a frame is ready by the time it has to be sent.
+        """
+        encoding = self.encoding
+        ended = False
+        self.loops = 0
+        self._start = time.time()
+        while not self._end.is_set():
+            if not self._resumed.is_set():
+                self._resumed.wait()
+
+            if not self._connected.is_set():
                 self.stop()
                 break
 
-            self.player(data)
+            while not ended and encoding.pending < encoding.depth:
+                data = self.buff.read(self.frame_size)
+                if self._volume != 1.0:
+                    data = audioop.mul(data, 2, min(self.volume, 2.0))
+                if len(data) != self.frame_size:
+                    ended = True
+                    break
+                encoding.submit(data)
+
+            if encoding.pending == 0:
+                self._completed = True
+                self.stop()
+                break
+
+            self.loops += 1
+            packet = encoding.result(self._delay)
+            if packet is not None:
+                self.player(packet, encode=False)
+                if self.cache_writer is not None:
+                    self._record(packet)
+            elif _drop_sampler():
+                log.warning('The encoder process fell behind, skipped a frame')
             next_time = self._start + self._delay * self.loops
             delay = max(0, self._delay + (next_time - time.time()))
             time.sleep(delay)
 
     def run(self):
         try:
-            self._do_run()
+            if self.encoding is not None:
+                self._do_run_pooled()
+            else:
+                self._do_run()
         except Exception as e:
             self._current_error = e
             self.stop()
             raise e
         finally:
+            if self.encoding is not None:
+                self.encoding.close()
+            if self.cache_writer is not None:
+                if self._completed and self._stream_ok():
+                    self.cache_writer.finish(self._delay)
+                else:
+                    self.cache_writer.abort()
             self._call_after()
 
+    def _record(self, packet):
+        if self._volume != 1.0:
+            # the entry would keep the volume it was played at
+            self.cache_writer.abort()
+            self.cache_writer = None
+        else:
+            self.cache_writer.write(packet)
+
+    def _stream_ok(self):
+        """Whether the stream ended because everything was read, and not because its source failed"""
+        return True
+
     def _call_after(self):
         if self.after is not None:
             try:
@@ -114,7 +202,7 @@ class StreamPlayer(threading.Thread):
 
     @volume.setter
     def volume(self, value):
-        self._volume = map(value, 0.0)
+        self._volume = max(value, 0.0)
 
     def pause(self):
         self._resumed.clear()
@@ -132,19 +220,67 @@ class StreamPlayer(threading.Thread):
 
 class ProcessPlayer(StreamPlayer):
     def __init__(self, process, client, after, **kwargs):
-        super().__init__(process.stdout, client.encoder, client._connected,
-                         client.play_audio, after, **kwargs)
+        super().__init__(process.stdout, client.encoder, client._connected, client.play_audio, after, **kwargs)
         self.process = process
+        self._encoder_pool = client.encoder_pool
+        self._encoder = client.encoder
 
     def run(self):
+        # taken only now, a player that is never started must not hold a worker slot
+        if self._encoder_pool is not None:
+            self.encoding = self._encoder_pool.open(self._encoder)
         super().run()
 
         self.process.kill()
         if self.process.poll() is None:
             self.process.communicate()
 
+    def _stream_ok(self):
+        # ffmpeg closes its output on errors as well
+        try:
+            return self.process.wait(timeout=5) == 0
+        except subprocess.TimeoutExpired:
+            return False
+
+class PacketPlayer(StreamPlayer):
+    """
+    Plays Opus packets from the audio cache as they are, nothing is decoded or encoded.
+    The volume can not be changed, the packets would have to be decoded for that.
+    """
+    def __init__(self, reader, client, after, **kwargs):
+        super().__init__(reader, client.encoder, client._connected, client.play_audio, after, **kwargs)
+
+    def _do_run(self):
+        self.loops = 0
+        self._start = time.time()
+        while not self._end.is_set():
+            if not self._resumed.is_set():
+                self._resumed.wait()
+
+            if not self._connected.is_set():
+                self.stop()
+                break
+
+            self.loops += 1
+            packet = self.buff.read_packet()
+            if packet is None:
+                self.stop()
+                break
+
+            self.player(packet, encode=False)
+            next_time = self._start + self._delay * self.loops
+            delay = max(0, self._delay + (next_time - time.time()))
+            time.sleep(delay)
+
+    def run(self):
+        try:
+            super().run()
+        finally:
+            self.buff.close()
+
 class VoiceClient:
-    def __init__(self, user, main_ws, session_id, channel, data, loop):
+    def __init__(self, user, main_ws, session_id, channel, data, loop, reconnects=None, encoder_pool=None,
+                 audio_cache=None):
         if not has_nacl:
             raise RuntimeError("PyNaCl library needed in order to use voice")
 
@@ -155,12 +291,20 @@ class VoiceClient:
         self.loop = loop
         self._connected = asyncio.Event(loop=self.loop)
         self.token = data.get('token')
-        self.guild_id = data.get('guild_id')
+        self.guild_id = snowflake(data.get('guild_id'))
         self.endpoint = data.get('endpoint')
         self.sequence = 0
         self.timestamp = 0
         self.encoder = opus.Encoder(48000, 2)
+        # worker processes the players encode in, None to encode on the player threads
+        self.encoder_pool = encoder_pool
+        # remote audio played before is played from here, see darkPy.audio_cache
+        self.audio_cache = audio_cache
         self.player = None
+        self.reconnects = ReconnectManager(loop=loop) if reconnects is None else reconnects
+        # phase -> seconds it took during the last connect, see join_phases
+        self.timings = {}
+        self._phase_started = None
         log.info('created opus encoder with {0.__dict__}'.format(self.encoder))
 
     warn_nacl = not has_nacl
@@ -181,14 +325,17 @@ class VoiceClient:
     @asyncio.coroutine
     def connect(self):
         log.info('voice connection is connecting...')
+        started = self._phase_started = time.perf_counter()
         self.endpoint = self.endpoint.replace(':80', '')
-        self.endpoint_ip = socket.gethostbyname(self.endpoint)
+        self.endpoint_ip = yield from helpers.resolve_host(self.loop, self.endpoint)
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.setblocking(False)
+        self.phase_done('resolve')
 
         log.info('Voice endpoint found {0.endpoint} (IP: {0.endpoint_ip})'.format(self))
 
         self.ws = yield from VoiceGateway.from_client(self)
+        self.phase_done('websocket')
         while not self._connected.is_set():
             yield from self.ws.poll_event()
             if hasattr(self, 'secret_key'):
@@ -196,9 +343,28 @@ class VoiceClient:
                 # websocket events anymore
                 self._connected.set()
                 break
+        self.phase_done('session')
+        self.record_phase('total', time.perf_counter() - started + self.timings.get('gateway', 0.0))
+        log.info('Joined voice in guild %s in %.3fs (%s)', self.guild_id, self.timings['total'],
+                 ', '.join('{} {:.3f}s'.format(phase, self.timings[phase])
+                           for phase in join_phases[:-1] if phase in self.timings))
 
         self.loop.create_task(self.poll_voice_ws())
 
+    def record_phase(self, phase, seconds):
+        """
+        :param phase: One of join_phases
+        :type phase: str
+        """
+        self.timings[phase] = seconds
+        _join_histograms[phase].observe(seconds)
+
+    def phase_done(self, phase):
+        """Record the time since the previous phase ended as the time of ``phase``"""
+        now = time.perf_counter()
+        self.record_phase(phase, now - self._phase_started)
+        self._phase_started = now
+
     @asyncio.coroutine
     def poll_voice_ws(self):
         while self._connected.is_set():
@@ -227,6 +393,7 @@ class VoiceClient:
             raise ValueError('Must be a voice channel.')
 
         yield from self.main_ws.voice_state(self.guild_id, channel.id)
+        self.channel = channel
 
     def is_connected(self):
         """bool: Indicates if the voice client is connected to voice."""
@@ -330,19 +497,48 @@ class VoiceClient:
         if ytdl_options is not None and isinstance(ytdl_options, dict):
             opts.update(ytdl_options)
 
+        cache = self.audio_cache
+        if cache is not None:
+            cached = yield from cache.lookup(url)
+            if cached is not None:
+                reader, info = cached
+                log.info('playing URL {} from the cache'.format(url))
+                return self._create_cached_player(reader, info, url, kwargs.get('after'))
+
         ydl = youtube_dl.YoutubeDL(opts)
         func = functools.partial(ydl.extract_info, url, download=False)
         info = yield from self.loop.run_in_executor(None, func)
         if "entries" in info:
             info = info['entries'][0]
 
+        if cache is not None:
+            reader = yield from cache.get(info, url)
+            if reader is not None:
+                log.info('playing URL {} from the cache'.format(url))
+                return self._create_cached_player(reader, info, url, kwargs.get('after'))
+
         log.info('playing URL {}'.format(url))
         download_url = info['url']
         player = self.create_ffmpeg_player(download_url, **kwargs)
+        if cache is not None and kwargs.get('options') is None:
+            # streamed this time, played from disk the next, unless ffmpeg filters it
+            player.cache_writer = cache.writer(info)
 
         player.download_url = download_url
-        player.url = url
         player.yt = ydl
+        self._set_track_info(player, info, url)
+        return player
+
+    def _create_cached_player(self, reader, info, url, after):
+        self.player = PacketPlayer(reader, self, after)
+        self.player.download_url = None
+        self.player.yt = None
+        self._set_track_info(self.player, info, url)
+        return self.player
+
+    @staticmethod
+    def _set_track_info(player, info, url):
+        player.url = url
         player.views = info.get('view_count')
         player.is_live = bool(info.get('is_live'))
         player.likes = info.get('like_count')
@@ -367,7 +563,6 @@ class VoiceClient:
                 date = None
 
         player.upload_date = date
-        return player
 
     def play_audio(self, data, *, encode=True):
         """Sends an audio packet composed of the data.
@@ -377,7 +572,9 @@ class VoiceClient:
         data : bytes
             The *bytes-like-object* denoting PCM or Opus voice data.
         encode : bool
-            Indicates if ``data`` should be encoded into Opus."""
+            Indicates if ``data`` should be encoded into Opus.
+
+        Returns the Opus packet that was sent."""
         self.checked_add('sequence', 1, 65535)
         if encode:
             encoded_data = self.encoder.encode(data, self.encoder.samples_per_frame)
@@ -387,6 +584,8 @@ class VoiceClient:
         try:
             sent = self.socket.sendto(packet, (self.endpoint_ip, self.voice_port))
         except BlockingIOError:
-            log.warning('A packet has been dropped (seq: {0.sequence}, timestamp: ({0.timestamp})'.format(self))
+            if _drop_sampler():
+                log.warning('A packet has been dropped (seq: %s, timestamp: %s)', self.sequence, self.timestamp)
 
-        self.checked_add('timestamp', self.encoder.samples_per_frame, 4294967295)
\ No newline at end of file
+        self.checked_add('timestamp', self.encoder.samples_per_frame, 4294967295)
+        return encoded_data
\ No newline at end of file
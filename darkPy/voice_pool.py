@@ -0,0 +1,117 @@
+from collections import OrderedDict
+
+from darkPy import helpers, metrics
+
+log = helpers.setup_logger()
+
+idle_connections = metrics.registry.gauge('darkpy_voice_idle_connections', 'Voice connections kept open without playing')
+
+
+def _is_playing(voice):
+    return voice.player is not None and not voice.player.is_done()
+
+
+class VoicePool:
+    """
+    Keeps voice connections open after playback so the next clip in the guild does not have to join again.
+
+    An idle connection is disconnected after ``idle_timeout`` seconds. When more than ``max_idle`` connections
+    are idle, the one idle the longest is disconnected first.
+    """
+
+    def __init__(self, client, *, idle_timeout=300.0, max_idle=10):
+        """
+        :type client: darkPy.client.Client
+        :param idle_timeout: Seconds an idle connection is kept, None to keep it until it is evicted
+        :type idle_timeout: float
+        :param max_idle: The maximum amount of idle connections over all guilds, 0 disconnects after every clip
+        :type max_idle: int
+        """
+        self.client = client
+        self.loop = client.loop
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        # guild id -> (voice client, timer handle), longest idle first
+        self._idle = OrderedDict()
+        idle_connections.set_function(lambda pool: len(pool._idle), owner=self)
+
+    def __len__(self):
+        return len(self._idle)
+
+    def acquire(self, guild):
+        """
+        Take the connection of a guild out of the pool
+
+        :type guild: darkPy.guild.Guild
+        :return: The connected voice client of the guild, or None when there is none
+        :rtype: darkPy.voice_client.VoiceClient
+        """
+        self._forget(guild.id)
+        voice = self.client.voice_client_in(guild)
+        if voice is not None and not voice.is_connected():
+            return None
+        return voice
+
+    def release(self, voice, player=None):
+        """
+        Put a connection that finished playing in the pool, must be called on the event loop
+        :type voice: darkPy.voice_client.VoiceClient
+        :param player: The player that finished, nothing happens when another one is playing by now
+        :type player: darkPy.voice_client.StreamPlayer
+        """
+        if not voice.is_connected():
+            return
+        if player is not None and (voice.player is not player or not player.is_done()):
+            return
+        self._forget(voice.guild_id)
+        if self.max_idle <= 0:
+            self._disconnect(voice)
+            return
+        handle = None
+        if self.idle_timeout is not None:
+            handle = self.loop.call_later(self.idle_timeout, self._expire, voice)
+        self._idle[voice.guild_id] = (voice, handle)
+        while len(self._idle) > self.max_idle:
+            _, (oldest, handle) = self._idle.popitem(last=False)
+            if handle is not None:
+                handle.cancel()
+            if _is_playing(oldest):
+                # not idle anymore, it only leaves the pool
+                continue
+            log.debug('Too many idle voice connections, disconnecting from guild %s', oldest.guild_id)
+            self._disconnect(oldest)
+
+    def releaser(self, voice):
+        """
+        :return: A callback for the ``after`` of a player, it runs on the player thread
+        :rtype: callable
+        """
+        def after(player):
+            self.loop.call_soon_threadsafe(self.release, voice, player)
+
+        return after
+
+    def clear(self):
+        """Forget every idle connection without disconnecting them"""
+        for _, handle in self._idle.values():
+            if handle is not None:
+                handle.cancel()
+        self._idle.clear()
+
+    def _forget(self, guild_id):
+        entry = self._idle.pop(guild_id, None)
+        if entry is not None and entry[1] is not None:
+            entry[1].cancel()
+
+    def _expire(self, voice):
+        entry = self._idle.get(voice.guild_id)
+        if entry is None or entry[0] is not voice:
+            return
+        del self._idle[voice.guild_id]
+        if _is_playing(voice):
+            return
+        log.debug('Voice connection in guild %s was idle for %ss, disconnecting', voice.guild_id, self.idle_timeout)
+        self._disconnect(voice)
+
+    def _disconnect(self, voice):
+        self.loop.create_task(voice.disconnect())
@@ -0,0 +1,104 @@
+import sys
+import threading
+import time
+import traceback
+
+from darkPy import helpers, metrics
+
+log = helpers.setup_logger()
+
+loop_blocks = metrics.registry.counter('darkpy_event_loop_blocks_total',
+                                       'Times the event loop did not turn over within the watchdog threshold',
+                                       ('callback',))
+loop_block_duration = metrics.registry.histogram('darkpy_event_loop_block_seconds',
+                                                 'How long the event loop was blocked, per detected block',
+                                                 (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+
+
+def _describe(frame):
+    """
+    Name the callback the loop was running in a stack, from the asyncio Handle executing it
+    :rtype: str
+    """
+    while frame is not None:
+        code = frame.f_code
+        if code.co_name == '_run' and code.co_filename.endswith('events.py'):
+            callback = getattr(frame.f_locals.get('self'), '_callback', None)
+            task = getattr(callback, '__self__', None)
+            # a task step, the coroutine is what was running
+            get_coro = getattr(task, 'get_coro', None)
+            coro = get_coro() if get_coro is not None else getattr(task, '_coro', None)
+            if coro is not None:
+                return getattr(coro, '__qualname__', repr(coro))
+            return getattr(callback, '__qualname__', repr(callback))
+        frame = frame.f_back
+    return 'unknown'
+
+
+class LoopWatchdog:
+    """
+    Detects when the event loop is blocked, from a separate thread.
+
+    The loop updates a timestamp every ``interval`` seconds. When the watchdog thread sees it got older than
+    ``threshold``, it captures the stack of the loop thread right then, so the blocking code is in it, not the
+    code that runs after. The block is logged with that stack and counted per callback; its duration is
+    recorded when the loop turns over again. Costs one timer callback per interval on the loop.
+    """
+
+    def __init__(self, loop, *, threshold=0.25, interval=None):
+        """
+        :param threshold: Seconds the loop may go without turning over before it counts as blocked
+        :type threshold: float
+        :param interval: Seconds between the loop updating its timestamp, a quarter of the threshold by default
+        :type interval: float
+        """
+        self.loop = loop
+        self.threshold = threshold
+        self.interval = threshold / 4 if interval is None else interval
+        self.blocks = 0
+        self._last_tick = time.monotonic()
+        self._loop_thread = None
+        self._timer = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stopped.clear()
+        self.loop.call_soon_threadsafe(self._tick)
+        self._thread = threading.Thread(target=self._watch, name='darkPy loop watchdog', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _tick(self):
+        # runs on the loop
+        self._loop_thread = threading.get_ident()
+        self._last_tick = time.monotonic()
+        if not self._stopped.is_set():
+            self._timer = self.loop.call_later(self.interval, self._tick)
+
+    def _watch(self):
+        blocked_since = None
+        while not self._stopped.wait(self.interval):
+            last_tick = self._last_tick
+            stalled = time.monotonic() - last_tick - self.interval
+            if blocked_since is not None:
+                if last_tick != blocked_since:
+                    # the loop turned over again
+                    duration = last_tick - blocked_since - self.interval
+                    loop_block_duration.observe(duration)
+                    log.warning('Event loop was blocked for %.3fs', duration)
+                    blocked_since = None
+                continue
+            if stalled > self.threshold and self._loop_thread is not None:
+                blocked_since = last_tick
+                self.blocks += 1
+                frame = sys._current_frames().get(self._loop_thread)
+                callback = _describe(frame)
+                loop_blocks.inc(labels=(callback,))
+                log.warning('Event loop blocked for more than %.3fs in %s:\n%s', stalled, callback,
+                            ''.join(traceback.format_stack(frame)) if frame is not None else '')
@@ -1,11 +1,13 @@
-import asyncio
-import importlib
+import os
 import command_handlers.command_handlers as command_handlers
 
 from darkPy import helpers
+from darkPy.cache import CachePolicy
 from darkPy.client import Client
+from darkPy.hotreload import CommandReloader
+from darkPy.recorder import GatewayRecorder
 
-client = Client()
+production = os.environ.get("SOUNDBOT_PRODUCTION") == "1"
 
 log = helpers.setup_logger()
 
@@ -15,22 +17,29 @@ def main():
     with open("token.txt") as token_file:
         token = token_file.read()
     if token != "":
-        client.add_command('play', handle_play)
-        client.add_command('stop', handle_stop)
+        if production:
+            helpers.enable_production_logging()
+        # created here and not on import, the encoder processes import this module again
+        # a soundboard only needs guilds, voice channels and voice states
+        client = Client(debug=not production, cache_policy=CachePolicy.voice_only(),
+                        session_file=os.environ.get("SOUNDBOT_SESSION_FILE", "session.json"), sound_directory="audio",
+                        encoder_processes=int(os.environ.get("SOUNDBOT_ENCODER_PROCESSES", "0")),
+                        audio_cache_directory=os.environ.get("SOUNDBOT_AUDIO_CACHE", "cache/audio"),
+                        audio_cache_bytes=int(os.environ.get("SOUNDBOT_AUDIO_CACHE_BYTES", str(1 << 30))))
+        reloader = CommandReloader(client, command_handlers, {'play': 'handle_play', 'stop': 'handle_stop'})
+        if production:
+            reloader.install()
+        else:
+            # pick up edits to the handlers without restarting
+            reloader.start()
+        # a newer !play replaces one still waiting, !stop goes before everything waiting in the guild
+        client.commands.configure('play', cooldown=2.0, coalesce=True)
+        client.commands.configure('stop', priority=True)
+        recording = os.environ.get("SOUNDBOT_RECORD")
+        if recording:
+            GatewayRecorder(recording).attach(client)
         client.run(token)
 
 
-@asyncio.coroutine
-def handle_play(args, message):
-    importlib.reload(command_handlers)
-    yield from command_handlers.handle_play(args, message, client)
-
-
-@asyncio.coroutine
-def handle_stop(args, message):
-    importlib.reload(command_handlers)
-    yield from command_handlers.handle_stop(args, message, client)
-
-
 if __name__ == "__main__":
     main()
@@ -0,0 +1,40 @@
+import unittest
+
+from darkPy import model
+from darkPy.benchmark import make_guild
+from darkPy.guild import Guild
+
+
+class GuildPayloadTest(unittest.TestCase):
+
+    def test_empty_preloaded_members(self):
+        data = make_guild(1, members=0)
+        guild = Guild(data, preload_members=True)
+        self.assertEqual(guild.cached_member_count, 0)
+        self.assertNotIn('members', guild._payload)
+        self.assertEqual(len(guild.members), 0)
+
+    def test_preloaded_members_are_counted_before_building(self):
+        guild = Guild(make_guild(1, members=3), preload_members=True)
+        self.assertEqual(guild.cached_member_count, 3)
+        self.assertEqual(len(guild.members), 3)
+
+    def test_hydrated_after_building_everything(self):
+        guild = Guild(make_guild(1, channels=2, roles=0))
+        self.assertFalse(guild.hydrated)
+        guild.roles, guild.emojis, guild.members, guild.channels
+        self.assertTrue(guild.hydrated)
+
+
+    def test_extra_only_keeps_unknown_fields(self):
+        self.addCleanup(setattr, model, 'keep_unknown_fields', model.keep_unknown_fields)
+        model.keep_unknown_fields = True
+        data = make_guild(1, members=2)
+        data['presences'] = []
+        data['some_new_field'] = 1
+        guild = Guild(data, preload_members=True)
+        self.assertEqual(guild.extra, {'some_new_field': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
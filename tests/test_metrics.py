@@ -0,0 +1,36 @@
+import gc
+import unittest
+
+from darkPy import metrics
+
+
+class Owner:
+
+    def __init__(self, size):
+        self.size = size
+
+
+class GaugeFunctionTest(unittest.TestCase):
+
+    def test_function_of_an_owner(self):
+        gauge = metrics.Gauge('test_size', 'Size')
+        owner = Owner(3)
+        gauge.set_function(lambda obj: obj.size, ('a',), owner=owner)
+        self.assertEqual(gauge.collect(), {('a',): 3})
+        owner.size = 5
+        self.assertEqual(gauge.collect(), {('a',): 5})
+
+    def test_owner_is_not_kept_alive(self):
+        gauge = metrics.Gauge('test_size', 'Size')
+        gauge.set_function(lambda obj: obj.size, ('a',), owner=Owner(3))
+        gc.collect()
+        self.assertEqual(gauge.collect(), {})
+        self.assertEqual(gauge._functions, {})
+
+    def test_replaced_owner_keeps_its_series(self):
+        gauge = metrics.Gauge('test_size', 'Size')
+        gauge.set_function(lambda obj: obj.size, ('a',), owner=Owner(3))
+        owner = Owner(4)
+        gauge.set_function(lambda obj: obj.size, ('a',), owner=owner)
+        gc.collect()
+        self.assertEqual(gauge.collect(), {('a',): 4})